@@ -2,7 +2,8 @@ import json
 import os
 
 from config import RESULT_DIR
-from privacy.postprocessing import resample_cartesian, resample_uniform
+from privacy.postprocessing import resample_cartesian_counts, resample_uniform
+from privacy.table import GeneralizedTable, TABLE_FORMATS
 
 CONF_ANON_MODE = (
     "G", "S", "GS",
@@ -13,7 +14,7 @@ CONF_QI_MAP = (
 )
 
 RESAMPLING_STRATEGIES = dict(
-    cartesian=resample_cartesian,
+    cartesian=resample_cartesian_counts,
     uniform=resample_uniform,
 )
 
@@ -112,10 +113,15 @@ CONF_VARS = dict(
 
 
 class Config:
-    def __init__(self, mode, attrs=None, qi_map=None):
+    def __init__(self, mode, attrs=None, qi_map=None, table_format="npz"):
+        """
+
+        :param table_format: Storage format of the tables, one of TABLE_FORMATS
+        """
         self.mode = mode
         self.qi_map = qi_map
         self.var_conf = attrs
+        self.table_format = table_format
 
     def __str__(self):
         return f"{self.mode}-{self.qi_map}-{self.var_conf}-ADULT"
@@ -143,6 +149,31 @@ class Config:
     def table_dir(self, resample):
         return os.path.join(self.dir, f"tables_resample_{resample}")
 
+    def table_file(self, table_dir, k, l, table_format=None):
+        return os.path.join(table_dir, f"K{k}L{l}.{table_format or self.table_format}")
+
+    def existing_table_file(self, table_dir, k, l):
+        """
+        File of a table in the configured format, or in any other format if it does not exist (e.g. CSV tables of
+        earlier runs)
+        """
+        table_file = self.table_file(table_dir, k, l)
+        if not os.path.exists(table_file):
+            for table_format in TABLE_FORMATS:
+                if os.path.exists(self.table_file(table_dir, k, l, table_format)):
+                    return self.table_file(table_dir, k, l, table_format)
+        return table_file
+
+    def read_table(self, table_dir, k, l, columns=None) -> GeneralizedTable:
+        """
+
+        :param columns: Columns to read (default: all)
+        """
+        return GeneralizedTable.load(self.existing_table_file(table_dir, k, l), columns)
+
+    def write_table(self, table: GeneralizedTable, table_dir, k, l):
+        table.save(self.table_file(table_dir, k, l))
+
     @property
     def table_dirs_resampling(self):
         return [self.table_dir(name) for name in sorted(RESAMPLING_STRATEGIES.keys())]
@@ -154,6 +185,10 @@ class Config:
     def result_files_resampling(self):
         return [self.result_file(name) for name in sorted(RESAMPLING_STRATEGIES.keys())]
 
+    @property
+    def replicates_file(self):
+        return os.path.join(self.dir, "results_resample_uniform_replicates.csv")
+
     def plot_file(self, resample, column):
         return os.path.join(self.plot_dir, f"{column}_{resample}.pdf")
 
@@ -164,6 +199,33 @@ class Config:
     def exp_file(self):
         return os.path.join(self.dir, "experiments.csv")
 
+    @property
+    def heuristics_file(self):
+        return os.path.join(self.dir, "heuristics.csv")
+
+    @property
+    def quasi_identifiers(self):
+        variables = CONF_VARS[self.var_conf]
+        if self.qi_map == "AI":
+            return variables["A"] + variables["I"]
+        elif self.qi_map == "A":
+            return variables["A"]
+        elif self.qi_map == "I":
+            return variables["I"]
+        else:
+            raise NotImplementedError(f"attr_map {self.qi_map} is not supported")
+
+    @property
+    def anonymizer_attributes(self):
+        """
+        :return: Pair of QI and grouping keys for BayardoExtendedAnonymizer
+        """
+        variables = CONF_VARS[self.var_conf]
+        if self.qi_map == "AI":
+            return variables["A"], variables["I"]
+        else:
+            return self.quasi_identifiers, []
+
     @property
     def use_suppression(self):
         return "S" in self.mode
@@ -1,10 +1,13 @@
 import os
 
+import numpy as np
 import pandas as pd
 
 from experiments.conf import Config
-from fairness import measure_fairness
-from privacy.models import get_l_distinct, get_k
+from fairness import measure_fairness, measure_fairness_replicates
+from privacy.models import get_metrics
+from privacy.postprocessing import resample_uniform
+from utils import COUNT_COLUMN
 
 
 def evaluate_experiment(conf: Config):
@@ -31,19 +34,22 @@ def evaluate_experiment(conf: Config):
         # Read tables
         for k, l in df_exp.index:
             print("Evaluating ({}, {}) ...".format(k, l))
-            table_file = os.path.join(table_dir, "K{}L{}.csv".format(k, l))
-            df = pd.read_csv(table_file, header=0, index_col=0)
+            table_file = conf.existing_table_file(table_dir, k, l)
+            df = conf.read_table(table_dir, k, l, columns=A + I + [S, O]).to_frame(strings=False)
+            # Weighted tables (e.g. cartesian resampling) have a count per row
+            count_column = COUNT_COLUMN if COUNT_COLUMN in df.columns else None
 
-            k_df, n_df = get_k(df, QI)
-            l_df = get_l_distinct(df, S, QI)
-            idx = (k_df, l_df)
+            metrics = get_metrics(df, S, QI, count_column)
+            idx = (metrics["k"], metrics["l_distinct"])
 
             if idx in indexes:
-                print(f"WARNING: index ({k_df}, {l_df}) already in {table_file}")
+                print(f"WARNING: index {idx} already in {table_file}")
 
-            measurements = measure_fairness(df, A, I, O, S)
+            measurements = measure_fairness(df, A, I, O, S, count_column)
             measurements.update(
-                n_groups=n_df,
+                n_groups=metrics["n_groups"],
+                l_entropy=metrics["l_entropy"],
+                t_closeness=metrics["t_closeness"],
                 idx_original=(k, l),
             )
 
@@ -58,3 +64,40 @@ def evaluate_experiment(conf: Config):
         print(f"Writing results to {result_file} ...", flush=True, end="")
         results.to_csv(result_file, index_label=["k", "l"], index=True)
         print(" done")
+
+
+def evaluate_replicates(conf: Config, replicates, seed=None, interval=0.95):
+    """
+    Evaluates uniform resampling with several replicates per anonymized table. The replicates are drawn and measured
+    in memory, only the mean and the percentile interval of every measure are written.
+
+    :param replicates: Number of resampled datasets per table
+    :param seed: Seed of the resampling
+    :param interval: Probability mass of the percentile interval
+    """
+    setup = conf.get_setup()
+    A = setup["A"]
+    I = setup["I"]
+    O = setup["O"]
+    S = setup["S"]
+    QI = setup["QI"]
+
+    rng = np.random.default_rng(seed)
+    percentiles = (50 * (1 - interval), 50 * (1 + interval))
+    df_exp = pd.read_csv(conf.exp_file, header=0, index_col=[0, 1])
+    rows = []
+    for k, l in df_exp.index:
+        print("Evaluating ({}, {}) with {} replicates ...".format(k, l, replicates))
+        table = conf.read_table(conf.base_table_dir, k, l, columns=A + I + [S, O])
+        measurements = measure_fairness_replicates(resample_uniform(table, QI, seed=rng, replicates=replicates),
+                                                   A, I, O, S)
+        row = dict(replicates=replicates)
+        for measure in measurements.columns:
+            row[f"{measure}_mean"] = measurements[measure].mean()
+            row[f"{measure}_low"], row[f"{measure}_high"] = np.percentile(measurements[measure], percentiles)
+        rows.append(row)
+
+    results = pd.DataFrame(rows, index=df_exp.index)
+    print(f"Writing results to {conf.replicates_file} ...", flush=True, end="")
+    results.to_csv(conf.replicates_file, index_label=["k", "l"], index=True)
+    print(" done")
@@ -0,0 +1,58 @@
+import os
+
+import pandas as pd
+
+from experiments.conf import Config, CONF_VARS
+from privacy.bayardoext import BayardoExtendedAnonymizer
+
+HEURISTICS = dict(
+    none=dict(reorder_values=False, prune_useless=False),
+    reorder=dict(reorder_values=True, prune_useless=False),
+    useless=dict(reorder_values=False, prune_useless=True),
+    both=dict(reorder_values=True, prune_useless=True),
+)
+
+
+def compare_heuristics(df, conf: Config, k_values=(2, 5, 10)):
+    """
+    A/B comparison of the search heuristics of BayardoAnonymizer. Reports visited nodes and durations per k.
+
+    :param df: Dataset
+    :param conf: Experiment configuration (mode must use generalization)
+    :param k_values: Values of k to anonymize for
+    :return: DataFrame indexed by (heuristics, k)
+    """
+    if not conf.use_generalization:
+        raise ValueError("Heuristics only apply to generalization")
+    if not os.path.exists(conf.dir):
+        os.mkdir(conf.dir)
+
+    variables = CONF_VARS[conf.var_conf]
+    qi, grouping_keys = conf.anonymizer_attributes
+    df = df[variables["A"] + variables["I"] + [variables["S"], variables["O"]]].copy()
+
+    indexes = []
+    rows = []
+    for name, heuristics in HEURISTICS.items():
+        print(f"---- Heuristics: {name} ----")
+        a = BayardoExtendedAnonymizer(df, qi, grouping_keys, use_suppression=conf.use_suppression,
+                                      use_generalization=conf.use_generalization, warm_start=False,
+                                      **heuristics)
+        for k in k_values:
+            if k > a.k_max:
+                continue
+            a.run(k)
+            indexes.append((name, k))
+            rows.append([a.node_count, a.duration.total_seconds(), a.best_cost])
+
+    results = pd.DataFrame(rows, columns=["nodes", "duration", "cost"],
+                           index=pd.MultiIndex.from_tuples(indexes, names=["heuristics", "k"]))
+    baseline = results.xs("none", level="heuristics")["nodes"]
+    results["node_reduction"] = [
+        1.0 - nodes / baseline[k] for (_, k), nodes in zip(results.index, results["nodes"])
+    ]
+    print(results)
+    print(f"INFO: Saving heuristics comparison to {conf.heuristics_file} ...", flush=True, end="")
+    results.to_csv(conf.heuristics_file, index=True)
+    print(" done")
+    return results
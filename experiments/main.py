@@ -9,17 +9,41 @@ from pandas import DataFrame
 import dataset
 from config import RESULT_DIR
 from experiments.conf import Config, CONF_ANON_MODE, CONF_VARS, CONF_QI_MAP
-from experiments.evaluate import evaluate_experiment
+from experiments.evaluate import evaluate_experiment, evaluate_replicates
+from experiments.heuristics import compare_heuristics
 from experiments.resample import resample_tables
 from privacy.bayardoext import BayardoExtendedAnonymizer
 from privacy.ldiversity import post_process_k_anonymity
-from privacy.models import get_k, get_l_distinct
-
-
-def run_privacy(df, conf: Config):
+from privacy.models import get_k, get_metrics
+from privacy.table import GeneralizedTable, TABLE_FORMATS
+from utils import COUNT_COLUMN, compress, expand
+
+
+def save_table(table: GeneralizedTable, conf: Config, k, l, export_csv=False):
+    """
+    Saves an anonymized table, optionally also as CSV with generalization strings (weighted tables are expanded into
+    one row per tuple)
+    """
+    conf.write_table(table, conf.base_table_dir, k, l)
+    if export_csv:
+        df_csv = table.to_frame()
+        if table.counts is not None:
+            df_csv = expand(df_csv)
+        df_csv.to_csv(conf.table_file(conf.base_table_dir, k, l, "csv"))
+
+
+def run_privacy(df, conf: Config, time_budget=None, node_budget=None, workers=1, export_csv=False,
+                checkpoint_dir=None, weighted=False, search_workers=1):
+    """
+    :param workers: Number of processes which anonymize the groups
+    :param search_workers: Number of processes which search the subtrees of each group (e.g. for a single large group),
+        not supported with checkpoints
+    :param weighted: Anonymize the distinct tuples with their counts (see utils.compress), the tables are weighted
+    :param checkpoint_dir: Directory for the checkpoints of the search, one subdirectory per configuration (None
+        disables checkpoints). An interrupted run started again resumes the search of the interrupted k.
+    """
     print(f"---- {conf.mode} - {conf.qi_map} - {conf.var_conf} ----")
 
-    table_file = os.path.join(conf.base_table_dir, "K{}L{}.csv")
     if not os.path.exists(conf.dir):
         os.mkdir(conf.dir)
     if not os.path.exists(conf.base_table_dir):
@@ -37,27 +61,32 @@ def run_privacy(df, conf: Config):
     else:
         raise NotImplementedError(f"attr_map {conf.qi_map} is not supported")
     df = df[A + I + [S, O]].copy()
-
-    print("DEBUG: Evaluating initial K-Anonymity ...")
-    k_current, n_groups = get_k(df, QI)
-    print("DEBUG: Evaluating initial L-Diversity...")
-    l_initial = get_l_distinct(df, S, QI)
+    count_column = None
+    if weighted:
+        df = compress(df)
+        count_column = COUNT_COLUMN
+        print("DEBUG: {} distinct tuples".format(len(df)))
+
+    print("DEBUG: Evaluating initial K-Anonymity and L-Diversity ...")
+    metrics = get_metrics(df, S, QI, count_column)
+    k_current, n_groups, l_initial = metrics["k"], metrics["n_groups"], metrics["l_distinct"]
     k_lst = [k_current]
     l_lst = [l_initial]
     n_lst = [n_groups]
     k_call = [0]
     cost_lst = [0]
+    lb_lst = [0]
     dur_lst = [0]
     print("DEBUG: Initializing anonymizer ...")
+    anonymizer_args = dict(use_suppression=conf.use_suppression, use_generalization=conf.use_generalization,
+                           group_workers=workers, workers=search_workers, count_column=count_column,
+                           checkpoint_dir=None if checkpoint_dir is None else os.path.join(checkpoint_dir, str(conf)))
     if conf.qi_map == "AI":
-        a = BayardoExtendedAnonymizer(
-            df, A, I, use_suppression=conf.use_suppression, use_generalization=conf.use_generalization)
+        a = BayardoExtendedAnonymizer(df, A, I, **anonymizer_args)
     elif conf.qi_map == "A":
-        a = BayardoExtendedAnonymizer(
-            df, A, [], use_suppression=conf.use_suppression, use_generalization=conf.use_generalization)
+        a = BayardoExtendedAnonymizer(df, A, [], **anonymizer_args)
     elif conf.qi_map == "I":
-        a = BayardoExtendedAnonymizer(
-            df, I, [], use_suppression=conf.use_suppression, use_generalization=conf.use_generalization)
+        a = BayardoExtendedAnonymizer(df, I, [], **anonymizer_args)
     else:
         raise NotImplementedError(f"attr_map {conf.qi_map} is not supported")
 
@@ -73,57 +102,59 @@ def run_privacy(df, conf: Config):
         l_initial=l_initial,
         n_groups=n_groups,
         k_max=a.k_max,
-        n=len(df),
+        n=a.size,
     )
     with open(conf.setup, "w") as f:
         f.write(json.dumps(setup))
 
     # Save initial dataset
     print("DEBUG: Saving initial dataset ...", flush=True)
-    df.to_csv(table_file.format(k_current, l_initial))
+    save_table(GeneralizedTable.from_frame(df, generalized=[]), conf, k_current, l_initial, export_csv)
 
     # Anonymize dataset
     while 0 < k_current < a.k_max:
         k = k_current + 1
         print(f"---- k = {k} ----")
-        df_kano = a.run(k)
+        df_kano = a.run(k, time_budget=time_budget, node_budget=node_budget)
         if df_kano.empty:
             print("INFO: Stopping. DataFrame is empty")
             break
         else:
-            l_df_kano = get_l_distinct(df_kano, S, QI)
-            k_current, n_groups = get_k(df_kano, QI)
+            metrics = get_metrics(df_kano, S, QI, count_column)
+            k_current, n_groups, l_df_kano = metrics["k"], metrics["n_groups"], metrics["l_distinct"]
 
         k_call.append(k)
         n_lst.append(n_groups)
         k_lst.append(k_current)
         l_lst.append(l_df_kano)
         cost_lst.append(a.best_cost)
+        lb_lst.append(a.lower_bound)
         dur_lst.append(a.duration)
 
         print(f"INFO: Saving {k_current}-anonymized table ...", flush=True, end="")
-        df_kano.to_csv(table_file.format(k_current, l_df_kano))
+        save_table(a.anonymized_table, conf, k_current, l_df_kano, export_csv)
         print(" done")
         if l_df_kano < 2 and df_kano[S].nunique() == 2:
             print(f"---- k = {k}, l = 2 ----")
             start = datetime.now()
-            df_ldiv = post_process_k_anonymity(df_kano, 2, S, QI)
-            k_ldiv, n_groups_ldiv = get_k(df_ldiv, QI)
+            table_ldiv = post_process_k_anonymity(df_kano, 2, S, QI, count_column=count_column, as_table=True)
+            k_ldiv, n_groups_ldiv = get_k(table_ldiv.to_frame(), QI, count_column)
 
             k_call.append(k)
             k_lst.append(k_ldiv)
             n_lst.append(n_groups_ldiv)
             l_lst.append(2)
             cost_lst.append(0)
+            lb_lst.append(0)
             dur_lst.append(datetime.now() - start)
             print("INFO: Finished in {}".format(dur_lst[-1]))
 
             print(f"INFO: Saving {k_ldiv}-anonymized 2-diverse table ...", flush=True, end="")
-            df_ldiv.to_csv(table_file.format(k_ldiv, 2))
+            save_table(table_ldiv, conf, k_ldiv, 2, export_csv)
             print(" done")
 
     # Save timing
-    results = DataFrame(dict(cost=cost_lst, duration=dur_lst, k_call=k_call, n_groups=n_lst),
+    results = DataFrame(dict(cost=cost_lst, lower_bound=lb_lst, duration=dur_lst, k_call=k_call, n_groups=n_lst),
                         index=pd.MultiIndex.from_arrays((k_lst, l_lst), names=["k", "l"]))
     print("INFO: Saving timing ...", flush=True, end="")
     results.to_csv(conf.exp_file, index_label=["k", "l"], index=True)
@@ -136,27 +167,56 @@ def main():
     parser.add_argument("--create", "-c", help="Anonymize datasets", action="store_true")
     parser.add_argument("--resample", "-r", action="store_true")
     parser.add_argument("--evaluate", "-e", help="Evaluate results", action="store_true")
+    parser.add_argument("--heuristics", help="Compare the search heuristics (visited nodes)", action="store_true")
+    parser.add_argument("--replicates", help="Evaluate this many uniform resamples per table (in memory)", type=int)
+    parser.add_argument("--seed", help="Seed of the uniform resampling (--resample and --replicates)", type=int)
+    parser.add_argument("--export-csv", help="Also save anonymized tables as CSV with generalization strings",
+                        action="store_true")
+    parser.add_argument("--table-format", help="Storage format of the tables (parquet and feather need pyarrow)",
+                        choices=TABLE_FORMATS, default="npz")
+    # Search budget
+    parser.add_argument("--time-budget", help="Seconds per k, best solution so far is used", type=float)
+    parser.add_argument("--node-budget", help="Visited nodes per k, best solution so far is used", type=int)
+    # Parallelism
+    parser.add_argument("--workers", help="Processes which anonymize the groups (0 for one per CPU)", type=int,
+                        default=1)
+    parser.add_argument("--search-workers", help="Processes which search the subtrees of a group (0 for one per CPU)",
+                        type=int, default=1)
+    parser.add_argument("--weighted", help="Anonymize the distinct tuples with their counts", action="store_true")
+    # Checkpoints
+    parser.add_argument("--checkpoint-dir", help="Save the search regularly, a restarted run resumes the interrupted k")
     # Positional
     parser.add_argument("mode", help="Mode", choices=CONF_ANON_MODE, nargs="?")
     parser.add_argument("qi", help="Attribute mapping (AI, A, I)", choices=CONF_QI_MAP, nargs="?")
     parser.add_argument("attrs", help="Var conf", choices=tuple(CONF_VARS.keys()), nargs="?")
     args = parser.parse_args()
+    if args.search_workers != 1 and args.checkpoint_dir is not None:
+        parser.error("--search-workers is not supported with --checkpoint-dir")
 
     if not os.path.exists(RESULT_DIR):
         os.mkdir(RESULT_DIR)
 
-    conf = Config(args.mode, attrs=args.attrs, qi_map=args.qi)
+    conf = Config(args.mode, attrs=args.attrs, qi_map=args.qi, table_format=args.table_format)
 
     if args.create:
         df = dataset.load_adult()
-        run_privacy(df, conf)
+        run_privacy(df, conf, time_budget=args.time_budget, node_budget=args.node_budget, workers=args.workers,
+                    export_csv=args.export_csv, checkpoint_dir=args.checkpoint_dir, weighted=args.weighted,
+                    search_workers=args.search_workers)
 
     if args.resample:
-        resample_tables(conf)
+        resample_tables(conf, seed=args.seed)
 
     if args.evaluate:
         evaluate_experiment(conf)
 
+    if args.replicates:
+        evaluate_replicates(conf, args.replicates, seed=args.seed)
+
+    if args.heuristics:
+        df = dataset.load_adult()
+        compare_heuristics(df, conf)
+
 
 if __name__ == '__main__':
     main()
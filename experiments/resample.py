@@ -1,17 +1,23 @@
 import os
 
+import numpy as np
 import pandas as pd
 
 from experiments.conf import Config, RESAMPLING_STRATEGIES
+from privacy.table import GeneralizedTable
 
 
-def resample_tables(conf: Config):
+def resample_tables(conf: Config, seed=None):
+    """
+    :param seed: Seed of the uniform resampling (the tables are drawn in order from one generator)
+    """
     # Load setup
     setup = conf.get_setup()
     QI = setup["QI"]
 
     # Resample tables
     results = pd.read_csv(conf.exp_file, header=0, index_col=[0, 1])
+    rng = np.random.default_rng(seed)
 
     for name, resample_func in RESAMPLING_STRATEGIES.items():
         print(f"INFO: Resampling {conf}-{name} ...")
@@ -20,9 +26,7 @@ def resample_tables(conf: Config):
 
         for idx, (k, l) in enumerate(results.index):
             print("Resampling k={}, l={} ({}/{}) ... ".format(k, l, idx + 1, len(results.index.values)), end="")
-            table_file = os.path.join(conf.base_table_dir, "K{}L{}.csv".format(k, l))
-            df = pd.read_csv(table_file, header=0, index_col=0)
-            df_resampled = resample_func(df, QI)
-            table_res_out = os.path.join(conf.table_dir(name), "K{}L{}.csv".format(k, l))
-            df_resampled.to_csv(table_res_out, index_label="k", index=True)
+            table = conf.read_table(conf.base_table_dir, k, l)
+            df_resampled = resample_func(table, QI, seed=rng)
+            conf.write_table(GeneralizedTable.from_frame(df_resampled, generalized=[]), conf.table_dir(name), k, l)
             print(f"{len(df_resampled)} lines written")
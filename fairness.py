@@ -1,12 +1,213 @@
-import sys
-
 import numpy as np
 import pandas as pd
 
-from utils import get_domain
+from privacy.base import pack_keys
+from utils import REPLICATE_COLUMN, get_domain
+
+
+def _as_list(attrs):
+    if isinstance(attrs, str):
+        return [attrs]
+    return list(attrs) if attrs else []
+
+
+def _encode(df: pd.DataFrame, attrs):
+    """
+    Enumerates the distinct (combinations of) values of the attributes in sorted order.
+
+    :return: Pair of code per row (-1 if a value is missing) and the values per code
+    """
+    if len(attrs) == 1:
+        codes, uniques = pd.factorize(df[attrs[0]], sort=True)
+        return codes, pd.Index(uniques, name=attrs[0])
+    columns = []
+    levels = []
+    for attr in attrs:
+        codes, uniques = pd.factorize(df[attr], sort=True)
+        columns.append(codes)
+        levels.append(uniques)
+    columns = np.column_stack(columns) if columns else np.zeros((len(df), 0), dtype=np.int64)
+    valid = (columns >= 0).all(axis=1)
+    keys, codes = np.unique(pack_keys(columns[valid], [max(len(level), 1) for level in levels]), return_inverse=True)
+    row_codes = np.full(len(df), -1, dtype=np.int64)
+    row_codes[valid] = codes
+    first = columns[valid][np.unique(codes, return_index=True)[1]]
+    index = pd.MultiIndex.from_arrays([level[first[:, j]] for j, level in enumerate(levels)], names=attrs)
+    return row_codes, index
 
 
-def contingency_matrices_iterator(df: pd.DataFrame, attrs_x, attrs_y, attrs_z):
+def encode_groups(df: pd.DataFrame, attrs_z):
+    """
+    Enumerates the groups of Z in sorted order (a single group if Z is empty).
+
+    :return: Pair of group code per row (-1 if a value is missing) and the values of Z per group
+    """
+    attrs_z = _as_list(attrs_z)
+    # Handle Z = \empty (in case of K-fairness)
+    if not attrs_z:
+        return np.zeros(len(df), dtype=np.int64), pd.RangeIndex(1)
+    return _encode(df, attrs_z)
+
+
+class ContingencyTensor:
+    """
+    Counts of the tuples for every combination of (Z, X, Y), i.e. one contingency matrix of X and Y per value of Z.
+    Values are encoded as integer codes and all counts are computed with a single np.bincount over the combined index.
+
+    Small tensors are stored as a dense array with shape (Z, X, Y). Large tensors store the non-empty cells only (sorted
+    by Z, COO format) and the matrices are built on demand.
+    """
+    MAX_DENSE_CELLS = 2 ** 24
+
+    def __init__(self, df: pd.DataFrame, attrs_x, attrs_y, attrs_z, count_column=None, sparse=None, groups=None):
+        """
+
+        :param df: Dataset
+        :param attrs_x: X
+        :param attrs_y: Y
+        :param attrs_z: Z (empty for a single matrix over the whole dataset)
+        :param count_column: Column with the number of tuples per row (None if every row is one tuple)
+        :param sparse: Store the non-empty cells only (default: if the dense tensor has more than MAX_DENSE_CELLS cells)
+        :param groups: Result of encode_groups(df, attrs_z) to share the encoding of Z between tensors
+        """
+        x_codes, self.x_index = _encode(df, _as_list(attrs_x))
+        y_codes, self.y_index = _encode(df, _as_list(attrs_y))
+        z_codes, self.z_index = encode_groups(df, attrs_z) if groups is None else groups
+        self.shape = (len(self.z_index), len(self.x_index), len(self.y_index))
+        n_cells = int(np.prod(self.shape, dtype=np.float64))
+        self.sparse = n_cells > self.MAX_DENSE_CELLS if sparse is None else sparse
+
+        valid = (x_codes >= 0) & (y_codes >= 0) & (z_codes >= 0)
+        index = (z_codes[valid].astype(np.int64) * self.shape[1] + x_codes[valid]) * self.shape[2] + y_codes[valid]
+        weights = None if count_column is None else df[count_column].to_numpy()[valid]
+        if self.sparse:
+            self.keys, inverse = np.unique(index, return_inverse=True)
+            self.counts = np.bincount(inverse, weights=weights).astype(np.int64)
+            # Rows with a count of 0 do not add cells
+            self.keys, self.counts = self.keys[self.counts > 0], self.counts[self.counts > 0]
+            # Cells of group z are keys[bounds[z]:bounds[z + 1]]
+            self.bounds = np.searchsorted(self.keys, np.arange(self.shape[0] + 1) * self.shape[1] * self.shape[2])
+        else:
+            self.tensor = np.bincount(index, weights=weights, minlength=n_cells).astype(np.int64).reshape(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, z):
+        """
+        Contingency matrix of group z over all values of X and Y (values absent from the group have zero counts)
+        """
+        if not self.sparse:
+            return self.tensor[z]
+        start, stop = self.bounds[z], self.bounds[z + 1]
+        matrix = np.zeros(self.shape[1:], dtype=np.int64)
+        x, y = np.divmod(self.keys[start:stop] - z * self.shape[1] * self.shape[2], self.shape[2])
+        matrix[x, y] = self.counts[start:stop]
+        return matrix
+
+    def __iter__(self):
+        for z in range(len(self)):
+            yield self[z]
+
+    def _cells(self):
+        z, xy = np.divmod(self.keys, self.shape[1] * self.shape[2])
+        x, y = np.divmod(xy, self.shape[2])
+        return z, x, y
+
+    def cell(self, x, y):
+        """
+        Counts of cell (x, y) for all groups
+
+        :param x: Code of the X value
+        :param y: Code of the Y value
+        """
+        if not self.sparse:
+            return self.tensor[:, x, y]
+        z, xs, ys = self._cells()
+        counts = np.zeros(self.shape[0], dtype=np.int64)
+        selected = (xs == x) & (ys == y)
+        counts[z[selected]] = self.counts[selected]
+        return counts
+
+    def present(self, axis):
+        """
+        Which values occur in which groups
+
+        :param axis: 1 for the values of X, 2 for the values of Y
+        :return: Boolean matrix with shape (Z, X) or (Z, Y)
+        """
+        if not self.sparse:
+            return self.tensor.sum(axis=3 - axis) > 0
+        z, x, y = self._cells()
+        present = np.zeros((self.shape[0], self.shape[axis]), dtype=bool)
+        present[z, x if axis == 1 else y] = True
+        return present
+
+    def _margins(self):
+        """
+        Totals, number of non-empty rows and number of non-empty columns per group
+        """
+        if not self.sparse:
+            rows = self.tensor.sum(axis=2)
+            columns = self.tensor.sum(axis=1)
+            return rows.sum(axis=1), np.count_nonzero(rows, axis=1), np.count_nonzero(columns, axis=1)
+        z, x, y = self._cells()
+        totals = np.bincount(z, weights=self.counts, minlength=self.shape[0]).astype(np.int64)
+        row_groups = np.unique(z * self.shape[1] + x) // self.shape[1]
+        column_groups = np.unique(z * self.shape[2] + y) // self.shape[2]
+        return (totals, np.bincount(row_groups, minlength=self.shape[0]),
+                np.bincount(column_groups, minlength=self.shape[0]))
+
+    def _rank_one(self, totals):
+        """
+        Exact test for rank at most 1 on the integer counts: all 2x2 minors of a non-negative matrix are zero iff every
+        count times the total equals the product of its row and column sums.
+        """
+        if not self.sparse:
+            rows = self.tensor.sum(axis=2)
+            columns = self.tensor.sum(axis=1)
+            return (self.tensor * totals[:, None, None] == rows[:, :, None] * columns[:, None, :]).all(axis=(1, 2))
+        z, x, y = self._cells()
+        row_keys, row_idx = np.unique(z * self.shape[1] + x, return_inverse=True)
+        column_keys, column_idx = np.unique(z * self.shape[2] + y, return_inverse=True)
+        row_sums = np.bincount(row_idx, weights=self.counts).astype(np.int64)
+        column_sums = np.bincount(column_idx, weights=self.counts).astype(np.int64)
+        # Empty cells within the non-empty rows and columns are minors with a non-zero product
+        n_cells = np.bincount(z, minlength=self.shape[0])
+        full = n_cells == (np.bincount(row_keys // self.shape[1], minlength=self.shape[0]) *
+                           np.bincount(column_keys // self.shape[2], minlength=self.shape[0]))
+        mismatch = self.counts * totals[z] != row_sums[row_idx] * column_sums[column_idx]
+        return full & (np.bincount(z, weights=mismatch, minlength=self.shape[0]) == 0)
+
+    def ranks(self):
+        """
+        Rank of the contingency matrix of every group (as np.linalg.matrix_rank). Matrices of rank 0 or 1 are found
+        with an exact integer test and matrices with two non-empty rows or columns otherwise have rank 2. Only the
+        remaining matrices are decomposed, with one batched SVD.
+        """
+        totals, n_rows, n_columns = self._margins()
+        ranks = np.where(totals > 0, 2, 0)
+        ranks[(totals > 0) & self._rank_one(totals)] = 1
+        rest = np.flatnonzero((ranks == 2) & (np.minimum(n_rows, n_columns) > 2))
+        if len(rest):
+            matrices = self.tensor[rest] if not self.sparse else np.stack([self[z] for z in rest])
+            singular = np.linalg.svd(matrices.astype(np.float64), compute_uv=False)
+            # Tolerance of np.linalg.matrix_rank for the matrix without its empty rows and columns
+            tol = singular.max(axis=1) * np.maximum(n_rows, n_columns)[rest] * np.finfo(np.float64).eps
+            ranks[rest] = np.count_nonzero(singular > tol[:, None], axis=1)
+        return ranks
+
+    def frame(self, z):
+        """
+        Contingency matrix of group z as DataFrame over the values of X and Y which occur in the group (as pd.crosstab)
+        """
+        matrix = self[z]
+        rows = matrix.sum(axis=1) > 0
+        columns = matrix.sum(axis=0) > 0
+        return pd.DataFrame(matrix[rows][:, columns], index=self.x_index[rows], columns=self.y_index[columns])
+
+
+def contingency_matrices_iterator(df: pd.DataFrame, attrs_x, attrs_y, attrs_z, count_column=None):
     """
     Create contingency matrices for (X;Y|Z)
 
@@ -14,74 +215,101 @@ def contingency_matrices_iterator(df: pd.DataFrame, attrs_x, attrs_y, attrs_z):
     :param list attrs_x: X
     :param list attrs_y: Y
     :param list attrs_z: Z
+    :param count_column: Column with the number of tuples per row (None if every row is one tuple)
     :return:
     """
-    if isinstance(attrs_x, str):
-        attrs_x = [attrs_x]
-    if isinstance(attrs_y, str):
-        attrs_y = [attrs_y]
-    if isinstance(attrs_z, str):
-        attrs_z = [attrs_z]
-
-    # Handle Z = \empty (in case of K-fairness)
-    if attrs_z:
-        groups = df.groupby(attrs_z)
-    else:
-        groups = [(None, df)]
+    tensor = ContingencyTensor(df, attrs_x, attrs_y, attrs_z, count_column)
+    for z in range(len(tensor)):
+        yield tensor.frame(z)
 
-    size = len(groups)
-    for idx, (_, df_grouped) in enumerate(groups):
-        sys.stdout.write("\rContingency matrices: {:.2%} ...".format((idx + 1.0) / size))
-        df_cross = pd.crosstab(
-            [df_grouped[attr] for attr in attrs_x],
-            [df_grouped[attr] for attr in attrs_y]
-        )
-        # cont_matrix = df_cross.to_numpy()
-        yield df_cross
-    sys.stdout.write(" done\n")
 
-
-def get_ratio_of_discr(df: pd.DataFrame, admissibles, outcome, sensitive):
+def _rods_per_group(tensor: ContingencyTensor):
     """
-    Compute adjusted Ratio of Observational Discrimination
+    Ratio of Observational Discrimination of every group of a binary (outcome; sensitive | Z) tensor
+
+    :return: Pair of values and which groups are counted (groups with ad = 0 are left out)
     """
-    dom_sensitive = sorted(get_domain(df, [sensitive]))
-    dom_outcome = sorted(get_domain(df, [outcome]))
+    if tensor.shape[1:] != (2, 2):
+        # A domain value is missing everywhere, no group has a 2x2 matrix
+        return np.ones(len(tensor)), np.ones(len(tensor), dtype=bool)
+    # Codes follow the sorted domains, i.e. s0 = o0 = 0 and s1 = o1 = 1
+    complete = tensor.present(1).all(axis=1) & tensor.present(2).all(axis=1)
+    cb = tensor.cell(1, 0) * tensor.cell(0, 1)
+    ad = tensor.cell(0, 0) * tensor.cell(1, 1)
 
-    if len(dom_sensitive) != 2 or len(dom_outcome) != 2:
-        return np.array([1.0])
+    # Groups without all four combinations count as 1
+    rods = np.ones(len(tensor))
+    np.divide(cb, ad, out=rods, where=complete & (ad != 0))
+    return rods, ~complete | (ad != 0)
 
-    s0 = dom_sensitive[0]
-    s1 = dom_sensitive[1]
-    o0 = dom_outcome[0]
-    o1 = dom_outcome[1]
 
-    cont_matrix_iter = contingency_matrices_iterator(df, outcome, sensitive, admissibles)
+def _binary_domains(df: pd.DataFrame, outcome, sensitive):
+    return len(get_domain(df, [sensitive])) == 2 and len(get_domain(df, [outcome])) == 2
 
-    rods = []
-    for cm in cont_matrix_iter:
-        if cm.shape == (2, 2):
-            cb = cm[s0][o1] * cm[s1][o0]
-            ad = cm[s0][o0] * cm[s1][o1]
-            if ad != 0:
-                rods.append(cb / ad)
-        else:
-            rods.append(1.0)
 
-    rods = np.array(rods)
-    return rods
+def get_ratio_of_discr(df: pd.DataFrame, admissibles, outcome, sensitive, count_column=None, groups=None):
+    """
+    Compute adjusted Ratio of Observational Discrimination
 
+    :param groups: Result of encode_groups(df, admissibles) (default: encoded from df)
+    """
+    if not _binary_domains(df, outcome, sensitive):
+        return np.array([1.0])
 
-def measure_fairness(df: pd.DataFrame, adm, inadm, outcome, sensitive):
-    rods = get_ratio_of_discr(df, adm, outcome, sensitive)
-    cm_ranks = [np.linalg.matrix_rank(cm.to_numpy()) for cm in contingency_matrices_iterator(df, outcome, inadm, adm)]
-    cm_ranks = np.array(cm_ranks)
+    rods, counted = _rods_per_group(ContingencyTensor(df, outcome, sensitive, admissibles, count_column, groups=groups))
+    return rods[counted]
+
+
+def measure_fairness(df: pd.DataFrame, adm, inadm, outcome, sensitive, count_column=None):
+    # Both tensors share the grouping by the admissible attributes
+    groups = encode_groups(df, adm)
+    rods = get_ratio_of_discr(df, adm, outcome, sensitive, count_column, groups=groups)
+    cm_ranks = ContingencyTensor(df, outcome, inadm, adm, count_column, groups=groups).ranks()
     return dict(
         n_cont=len(cm_ranks),
         rod=rods.mean(),
         rod_abs=np.abs(1 - rods.mean()),
-        size=len(df),
+        size=len(df) if count_column is None else int(df[count_column].sum()),
         ratio_fair=np.count_nonzero(cm_ranks == 1.0) / len(cm_ranks),
         rank_mean=cm_ranks.mean(),
         rank_median=np.median(cm_ranks),
     )
+
+
+def measure_fairness_replicates(df: pd.DataFrame, adm, inadm, outcome, sensitive, replicate_column=REPLICATE_COLUMN,
+                                count_column=None) -> pd.DataFrame:
+    """
+    measure_fairness of stacked datasets (e.g. resample_uniform with replicates) in one pass: the replicate is
+    prepended to the admissible attributes and the measures are aggregated per replicate.
+
+    :param replicate_column: Column with the number of the dataset per row
+    :return: DataFrame with the measures of measure_fairness per replicate
+    """
+    adm = [replicate_column] + _as_list(adm)
+    groups = encode_groups(df, adm)
+    replicates, group_replicates = np.unique(groups[1].get_level_values(0), return_inverse=True)
+
+    if _binary_domains(df, outcome, sensitive):
+        rods, counted = _rods_per_group(ContingencyTensor(df, outcome, sensitive, adm, count_column, groups=groups))
+        rod_replicates = group_replicates
+    else:
+        # A single value of 1 per replicate (see get_ratio_of_discr)
+        rods, counted = np.ones(len(replicates)), np.ones(len(replicates), dtype=bool)
+        rod_replicates = np.arange(len(replicates))
+    with np.errstate(invalid="ignore"):
+        rod = (np.bincount(rod_replicates[counted], weights=rods[counted], minlength=len(replicates)) /
+               np.bincount(rod_replicates[counted], minlength=len(replicates)))
+
+    cm_ranks = ContingencyTensor(df, outcome, inadm, adm, count_column, groups=groups).ranks()
+    n_cont = np.bincount(group_replicates, minlength=len(replicates))
+    weights = None if count_column is None else df[count_column].to_numpy()
+    return pd.DataFrame(dict(
+        n_cont=n_cont,
+        rod=rod,
+        rod_abs=np.abs(1 - rod),
+        size=np.bincount(pd.Index(replicates).get_indexer(df[replicate_column]), weights=weights,
+                         minlength=len(replicates)).astype(np.int64),
+        ratio_fair=np.bincount(group_replicates, weights=cm_ranks == 1, minlength=len(replicates)) / n_cont,
+        rank_mean=np.bincount(group_replicates, weights=cm_ranks, minlength=len(replicates)) / n_cont,
+        rank_median=pd.Series(cm_ranks).groupby(group_replicates).median().to_numpy(),
+    ), index=pd.Index(replicates, name=replicate_column))
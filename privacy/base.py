@@ -1,93 +1,323 @@
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
+import numpy as np
 import pandas as pd
 from more_itertools import flatten
 
+from privacy.cache import LRUCache
+from privacy.table import GeneralizedColumn, GeneralizedTable
 from utils import format_generalization
 
 
-def gen_dict(anonymization, dom_values_enum):
-    def f(x):
-        for idx in range(len(anonymization) - 1):
-            if anonymization[idx] <= x < anonymization[idx + 1]:
-                return anonymization[idx]
-        return anonymization[-1]
+def pack_keys(columns, radices):
+    """
+    Packs the columns of an integer matrix into one integer key per row (mixed radix). If the key space would overflow
+    int64, the partial keys are re-enumerated densely before the next column is added.
+
+    :param columns: Integer matrix with shape (rows, attributes), column j takes values from [0, radices[j])
+    :param radices: Number of distinct values per column
+    :return: Array of int64 keys, equal rows share the same key
+    """
+    keys = np.zeros(len(columns), dtype=np.int64)
+    key_range = 1
+    for idx, radix in enumerate(radices):
+        # Python ints, NumPy integers would wrap around instead of exceeding the limit
+        radix = int(radix)
+        if key_range * radix > np.iinfo(np.int64).max:
+            _, keys = np.unique(keys, return_inverse=True)
+            keys = keys.astype(np.int64)
+            key_range = int(keys.max()) + 1
+        keys = keys * radix + columns[:, idx]
+        key_range *= radix
+    return keys
+
+
+def to_mask(values) -> int:
+    """
+    Converts enumerated values into a bitmask (bit v is set for value v).
+    """
+    mask = 0
+    for value in values:
+        mask |= 1 << value
+    return mask
+
+
+def to_values(mask) -> list:
+    """
+    Converts a bitmask into the sorted list of enumerated values.
+    """
+    values = []
+    while mask:
+        lowest = mask & -mask
+        values.append(lowest.bit_length() - 1)
+        mask ^= lowest
+    return values
+
+
+def popcount(mask) -> int:
+    return bin(mask).count("1")
+
+
+def split_budget(max_bytes, parts, share=1.0):
+    """
+    Part of a byte budget (None stays unbounded).
+
+    :param parts: Number of equal parts
+    :param share: Fraction of the budget which is split
+    """
+    return None if max_bytes is None else int(max_bytes * share) // parts
 
-    return dict((x, f(x)) for x in dom_values_enum)
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class SearchBudget:
+    """
+    Time and node budget of a search. One budget can be shared by several anonymizers.
+    """
+
+    def __init__(self, time_budget=None, node_budget=None):
+        """
+
+        :param time_budget: Seconds (or timedelta) after which the search stops, counted from the first start()
+        :param node_budget: Number of nodes after which the search stops
+        """
+        if isinstance(time_budget, timedelta):
+            time_budget = time_budget.total_seconds()
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.nodes = 0
+        self._deadline = None
+
+    def start(self):
+        if self.time_budget is not None and self._deadline is None:
+            self._deadline = time.monotonic() + self.time_budget
+
+    @property
+    def deadline(self):
+        return self._deadline
+
+    @property
+    def exhausted(self):
+        if self.node_budget is not None and self.nodes >= self.node_budget:
+            return True
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    def consume(self):
+        """
+        Counts one visited node.
+
+        :raises BudgetExhausted: if the budget is used up
+        """
+        self.nodes += 1
+        if self.exhausted:
+            raise BudgetExhausted()
+
+
+class SharedBudget(SearchBudget):
+    """
+    Search budget of worker processes. The node counter is a shared multiprocessing value, the deadline is taken over
+    from the budget of the parent process.
+    """
+
+    def __init__(self, deadline, node_budget, nodes):
+        """
+
+        :param deadline: Deadline (time.monotonic) or None
+        :param node_budget: Number of nodes visited by all processes after which the search stops
+        :param nodes: Shared counter (multiprocessing.Value)
+        """
+        super(SharedBudget, self).__init__(None, node_budget)
+        self._deadline = deadline
+        self._nodes = nodes
+
+    def consume(self):
+        with self._nodes.get_lock():
+            self._nodes.value += 1
+            self.nodes = self._nodes.value
+        if self.exhausted:
+            raise BudgetExhausted()
 
 
 class BaseAnonymizer:
     """
-    Important note: The here-user "set" means an ordered set why it is implemented as list.
+    Important note: Head and tail "sets" are bitmasks over the enumerated values (see to_mask and to_values).
 
     According to the Bayardo-paper, we enumerate all values from each domain.
     We convert the original dataset into a representation with every original value is replaced by its unique number.
+
+    Equivalence classes are tracked as partitions (class id per tuple and class sizes). A partition of a head set is
+    derived from the partition of its parent (head set without one value) by splitting only the classes that contain
+    tuples at the new boundary.
     """
+    DEFAULT_CACHE_BYTES = 128 * 2 ** 20
+
+    def __init__(self, data_frame, quasi_identifiers, use_suppression=False, cache_bytes=DEFAULT_CACHE_BYTES,
+                 cache_type=LRUCache, warm_start=True, sort_output=False, cost_backend="partition",
+                 count_column=None):
+        """
 
-    def __init__(self, data_frame, quasi_identifiers, use_suppression=False):
+        :param data_frame:
+        :param quasi_identifiers:
+        :param use_suppression:
+        :param cache_bytes: Byte budget of all caches of the anonymizer, shared evenly by the equivalence class and
+            partition caches (None for unbounded caches)
+        :param cache_type: Cache class, e.g. LRUCache or CostAwareCache
+        :param warm_start: Start each run with the solution of the previous run (see run), ignored with suppression
+        :param sort_output: Sort the anonymized dataset by all columns
+        :param cost_backend: Computation of equivalence class sizes, "partition" (refines partitions of the tuples) or
+            "cube" (sums blocks of a histogram of the QI values, see DataCube)
+        :param count_column: Column with the number of tuples each row stands for (None if every row is one tuple)
+        """
         # Parameters
         self.original_column_order = data_frame.columns
         self.dataframe = data_frame[sorted(data_frame.columns)]
-        self._dataframe_qi = None
         self.quasi_identifiers = sorted(quasi_identifiers)
         self.use_suppression = use_suppression
+        self.cache_bytes = cache_bytes
+        self.cache_type = cache_type
+        self.warm_start = warm_start
+        self.sort_output = sort_output
+        if cost_backend not in ("partition", "cube"):
+            raise ValueError("Unknown cost backend {}".format(cost_backend))
+        self.cost_backend = cost_backend
+        self.count_column = count_column
+        # Caches (independent of k, kept between runs)
+        self._eq_class_cache = cache_type(split_budget(cache_bytes, 2))
+        self._partition_cache = cache_type(split_budget(cache_bytes, 2))
         # Stateful variables (change each run)
         self.best_head = None
         self.best_cost = None
-        self._eq_class_cache = dict()
+        self.lower_bound = None
+        self.optimal = None
+        self.node_count = 0
+        self.reused = False
+        self.stopped = False
+        self._budget = None
+        self._fallback = (None, float("inf"))
         self._k = None
         self._df_anonymized = None
+        self._output_rows = None
         self.duration = None
         # Generate datasets
-        self.dataset_original = []
-        self.dataset_enum = []
+        self.dataset_enum = None
         self.attr_count = 0
         self.size = 0
+        self.weights = None
         self.domains = []
+        self.domain_offsets = []
         self.dom_values = []
         self.dom_values_enum = []
         self.most_general_anonymization = []
         self.sigma_all = []
+        self.general_mask = 0
+        self.sigma_mask = 0
+        self._rows_by_value = None
+        self._value_ptr = None
+        self._cube = None
         self._init_dataset()
 
     @property
     def anonymized_df(self):
         return self._df_anonymized
 
+    @property
+    def anonymized_table(self):
+        return None if self._df_anonymized is None else self.generate_table()
+
     @property
     def k_max(self):
         return self.size
 
+    @property
+    def cache_stats(self):
+        return dict(eq_classes=self._eq_class_cache.stats, partitions=self._partition_cache.stats)
+
+    @property
+    def gap(self):
+        """
+        Difference between the best cost and the lower bound of the optimal cost (0 if the solution is optimal)
+        """
+        return self.best_cost - self.lower_bound
+
     def _reset_state(self, k):
         self.best_cost = float("inf")
         self.best_head = None
+        self.lower_bound = float("inf")
+        self.optimal = None
+        self.node_count = 0
+        self.reused = False
+        self.stopped = False
+        self._fallback = (None, float("inf"))
         self.duration = None
         self._k = k
         self._df_anonymized = None
 
-    def _get_domain(self, attr_idx):
-        return sorted({x[attr_idx] for x in self.dataset_original})
-
     def _init_dataset(self):
         df_qi = self.dataframe[self.quasi_identifiers]
-        self.dataset_original = [tuple(x) for x in df_qi.to_numpy()]
-        self.size = len(self.dataset_original)
-        self.attr_count = len(self.dataset_original[0])
-        self.domains = [self._get_domain(i) for i in range(self.attr_count)]
+        if self.count_column is not None:
+            self.weights = self.dataframe[self.count_column].to_numpy(dtype=np.int64)
+            self.size = int(self.weights.sum())
+        else:
+            self.size = len(df_qi.index)
+        self.attr_count = len(self.quasi_identifiers)
+        # Factorize each attribute, codes are positions in the sorted domain
+        codes = []
+        for column in self.quasi_identifiers:
+            column_codes, uniques = pd.factorize(df_qi[column].to_numpy(), sort=True)
+            if (column_codes < 0).any():
+                raise ValueError("Quasi-identifier {} contains missing values".format(column))
+            codes.append(column_codes)
+            self.domains.append(list(uniques))
         # Generate numerical domain values
-        domain_offset = [0]
+        self.domain_offsets = [0]
         for idx in range(1, self.attr_count):
-            domain_offset.append(max(domain_offset) + len(self.domains[idx - 1]))
+            self.domain_offsets.append(self.domain_offsets[-1] + len(self.domains[idx - 1]))
         self.dom_values = list(flatten(self.domains))
         self.dom_values_enum = list(range(1, len(self.dom_values) + 1))
         # Generate most general anonymization
-        most_general_anonymization = set(x + 1 for x in domain_offset)
-        self.most_general_anonymization = sorted(most_general_anonymization)
+        self.most_general_anonymization = [offset + 1 for offset in self.domain_offsets]
         # Generate sigma
         self.sigma_all = sorted(set(self.dom_values_enum).difference(set(self.most_general_anonymization)))
+        self.general_mask = to_mask(self.most_general_anonymization)
+        self.sigma_mask = to_mask(self.sigma_all)
         # Generate enumerated dataset
-        self._dataframe_qi = df_qi.replace(self.dom_values, self.dom_values_enum)
-        self.dataset_enum = list(map(tuple, df_qi.replace(self.dom_values, self.dom_values_enum).to_numpy()))
+        dtype = np.int16 if len(self.dom_values) <= np.iinfo(np.int16).max else np.int32
+        self.dataset_enum = np.empty((len(df_qi.index), self.attr_count), dtype=dtype)
+        for idx, column_codes in enumerate(codes):
+            self.dataset_enum[:, idx] = column_codes + self.domain_offsets[idx] + 1
+        # Index tuples by enumerated value: tuples with value v are _rows_by_value[_value_ptr[v]:_value_ptr[v + 1]]
+        self._rows_by_value = np.argsort(self.dataset_enum, axis=0, kind="stable").T.ravel().astype(np.int32)
+        value_counts = np.bincount(self.dataset_enum.ravel(), minlength=len(self.dom_values) + 1)
+        self._value_ptr = np.concatenate(([0], np.cumsum(value_counts)))
+        if self.cost_backend == "cube":
+            from privacy.cube import DataCube
+            shape = [len(domain) for domain in self.domains]
+            self._cube = DataCube(np.column_stack(codes), shape, weights=self.weights)
+
+    def _generalize(self, anonymization):
+        """
+        Maps every enumerated value to the index of its generalization in the anonymization.
+
+        :param anonymization: Sorted anonymization (expanded head set)
+        :return: Tuple of index matrix with the shape of the enumerated dataset and the anonymization as array
+        """
+        bounds = np.asarray(anonymization, dtype=np.int64)
+        return np.searchsorted(bounds, self.dataset_enum, side="right") - 1, bounds
+
+    def _pack_eq_classes(self, gen_idx, bounds):
+        """
+        Packs each anonymized tuple into one integer key.
+
+        :param gen_idx: Index matrix as returned by _generalize
+        :param bounds: Anonymization as array
+        :return: Array of keys, one per tuple
+        """
+        attr_start = np.searchsorted(bounds, self.most_general_anonymization)
+        radices = np.diff(np.append(attr_start, len(bounds)))
+        return pack_keys(gen_idx - attr_start, radices)
 
     def generate_anonymized_dataset(self, anonymization):
         """
@@ -96,83 +326,270 @@ class BaseAnonymizer:
         :param anonymization:
         :return:
         """
-        d = gen_dict(anonymization, self.dom_values_enum)
-        ds_anonymized = [
-            tuple(d[value] for value in t) for t in self.dataset_enum
-        ]
-        return ds_anonymized
+        gen_idx, bounds = self._generalize(anonymization)
+        return list(map(tuple, bounds[gen_idx].tolist()))
+
+    def _weighted_counts(self, ids, rows=None):
+        """
+        Number of tuples per id.
+
+        :param ids: Id (from [0, n)) per row
+        :param rows: Rows the ids belong to (default: all rows)
+        :return: Array of n counts
+        """
+        if self.weights is None:
+            return np.bincount(ids)
+        weights = self.weights if rows is None else self.weights[rows]
+        return np.bincount(ids, weights=weights).astype(np.int64)
 
     def expand_head_set(self, head_set):
-        return sorted(head_set + self.most_general_anonymization)
+        """
+        :param head_set: head set as bitmask
+        :return: Sorted anonymization as list
+        """
+        return to_values(head_set | self.general_mask)
 
-    def generate_eq_classes(self, head_set):
+    def _refine_partition(self, partition, anonymization, value):
         """
-        Calculates equivalence classes and their members. Returns list of pairs, pair is equivalence class and members
+        Splits the partition of an anonymization at a new boundary value. Only tuples with a value in
+        [value, next boundary) are touched.
 
-        :param head_set: head set
-        :return:
+        :param partition: Pair of class ids (one per tuple) and class sizes
+        :param anonymization: Anonymization the partition belongs to as bitmask
+        :param value: New boundary (not part of anonymization)
+        :return: Partition of anonymization extended by value and number of touched tuples
+        """
+        class_ids, sizes = partition
+        higher = anonymization >> (value + 1)
+        end = value + (higher & -higher).bit_length() if higher else len(self.dom_values) + 1
+        rows = self._rows_by_value[self._value_ptr[value]:self._value_ptr[end]]
+        split_ids, inverse = np.unique(class_ids[rows], return_inverse=True)
+        split_sizes = self._weighted_counts(inverse, rows)
+        class_ids = class_ids.copy()
+        class_ids[rows] = len(sizes) + inverse
+        sizes = np.concatenate((sizes, split_sizes))
+        sizes[split_ids] -= split_sizes
+        return (class_ids, sizes), len(rows)
+
+    def generate_partition(self, head_set):
         """
-        anonymization = tuple(self.expand_head_set(head_set))
-        if anonymization in self._eq_class_cache:
-            return self._eq_class_cache[anonymization]
+        Calculates the partition of all tuples into equivalence classes induced by the head set. Classes can be empty.
 
-        # Generate anonymized dataset
-        ds_anonymized = self.generate_anonymized_dataset(anonymization)
+        :param head_set: head set as bitmask
+        :return: Pair of class ids (one per tuple) and class sizes
+        """
+        partition = self._partition_cache.get(head_set)
+        if partition is not None:
+            return partition
+
+        values = head_set
+        while values:
+            value = values.bit_length() - 1
+            values ^= 1 << value
+            parent = self._partition_cache.get(head_set ^ (1 << value))
+            if parent is not None:
+                anonymization = (head_set ^ (1 << value)) | self.general_mask
+                partition, cost = self._refine_partition(parent, anonymization, value)
+                break
+        else:
+            keys = self._pack_eq_classes(*self._generalize(self.expand_head_set(head_set)))
+            _, class_ids = np.unique(keys, return_inverse=True)
+            partition = class_ids.astype(np.int32), self._weighted_counts(class_ids)
+            cost = len(self.dataset_enum) * self.attr_count
+
+        # Cache and return
+        self._partition_cache.put(head_set, partition, cost=cost)
+        return partition
 
-        # Create equivalence classes
-        eq_classes = [
-            (eqc, ds_anonymized.count(eqc)) for eqc in
-            set(ds_anonymized)
-        ]
+    def eq_class_sizes(self, head_set):
+        """
+        Calculates the sizes of all equivalence classes induced by the head set.
+
+        :param head_set: head set as bitmask
+        :return: Array of class sizes
+        """
+        sizes = self._eq_class_cache.get(head_set)
+        if sizes is not None:
+            return sizes
+
+        if self._cube is not None:
+            # Interval starts per attribute, relative to the first value of the attribute
+            bounds = np.asarray(self.expand_head_set(head_set))
+            attr_start = np.searchsorted(bounds, self.most_general_anonymization)
+            sizes = self._cube.class_sizes([starts - starts[0] for starts in np.split(bounds, attr_start[1:])])
+            cost = self._cube.cells
+        else:
+            _, sizes = self.generate_partition(head_set)
+            sizes = sizes[sizes > 0]
+            cost = len(self.dataset_enum)
 
         # Cache and return
-        self._eq_class_cache[anonymization] = eq_classes
-        return eq_classes
+        self._eq_class_cache.put(head_set, sizes, cost=cost)
+        return sizes
+
+    def generate_eq_classes(self, head_set):
+        """
+        Calculates equivalence classes and their members. Returns list of pairs, pair is equivalence class and members
 
-    def run(self, k):
+        :param head_set: head set as bitmask
+        :return:
+        """
+        anonymization = self.expand_head_set(head_set)
+        gen_idx, bounds = self._generalize(anonymization)
+        keys = self._pack_eq_classes(gen_idx, bounds)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        sizes = self._weighted_counts(inverse)
+        labels = bounds[gen_idx[first]]
+        return [(tuple(eqc), int(size)) for eqc, size in zip(labels.tolist(), sizes)]
+
+    def run(self, k, time_budget=None, node_budget=None, budget=None):
+        """
+        Anonymizes the dataset. If the budget is exhausted, the search stops early and the best solution found so far
+        is used (stopped is True). Then, lower_bound is a lower bound of the optimal cost and optimal is False. With
+        suppression, the bound ignores that small equivalence classes may be suppressed, so lower_bound is NaN and the
+        solution is never reported as optimal.
+
+        With warm_start, the solution of the previous run is the initial incumbent. If the previous run was optimal for
+        a smaller k and none of its equivalence classes has a size in [previous k, k), its cost does not change and
+        costs of other solutions do not decrease, so it is still optimal and the search is skipped (reused is True).
+        The search with suppression is not exact (see above), so its result would depend on previous runs and it always
+        starts cold.
+
+        :param k:
+        :param time_budget: Seconds (or timedelta) for the search
+        :param node_budget: Number of nodes to visit
+        :param budget: SearchBudget (e.g. shared between anonymizers), replaces time_budget and node_budget
+        :return: Anonymized dataset
+        """
         # Integrity checks
         if not 1 <= k <= self.k_max:
             raise ValueError("k must be from [1, {}]".format(self.k_max))
-        self._reset_state(k)
-
         start = datetime.now()
-        self.anonymize()
+        if self._is_still_optimal(k):
+            self._k = k
+            self.node_count = 0
+            self.reused = True
+            self.duration = datetime.now() - start
+            return self._df_anonymized
+        previous_head = self.best_head if self._warm else None
+        self._reset_state(k)
+        self._budget = budget if budget is not None else SearchBudget(time_budget, node_budget)
+        self._budget.start()
+
+        if previous_head is not None:
+            cost = self.compute_cost(previous_head)
+            if cost < self.best_cost:
+                self.best_head, self.best_cost = previous_head, cost
+        try:
+            self.anonymize()
+        except BudgetExhausted:
+            self.stopped = True
+            if self._fallback[1] < self.best_cost:
+                self.best_head, self.best_cost = self._fallback
+        if self.use_suppression:
+            self.lower_bound = float("nan")
+        else:
+            self.lower_bound = min(self.lower_bound, self.best_cost)
+        self.optimal = not self.use_suppression and self.lower_bound >= self.best_cost
         self.duration = datetime.now() - start
         self._df_anonymized = self.generate_output()
         return self._df_anonymized
 
+    @property
+    def _warm(self):
+        return self.warm_start and not self.use_suppression
+
+    def _is_still_optimal(self, k) -> bool:
+        if not self._warm or not self.optimal or self._df_anonymized is None or k < self._k:
+            return False
+        sizes = self.eq_class_sizes(self.best_head)
+        return not ((self._k <= sizes) & (sizes < k)).any()
+
+    def _visit_node(self):
+        """
+        Counts a visited node of the search.
+
+        :raises BudgetExhausted: if the budget of the run is used up
+        """
+        self.node_count += 1
+        self._budget.consume()
+
+    def _offer_solution(self, head_set, cost):
+        """
+        Remembers a solution evaluated outside the search order. It is only used if the search stops early.
+        """
+        if cost < self._fallback[1]:
+            self._fallback = (head_set, cost)
+
+    def _bound_open_nodes(self, head_set, all_set):
+        """
+        Lowers the bound of the optimal cost by the lower bound of nodes which were not visited because the search
+        stopped early.
+        """
+        self.lower_bound = min(self.lower_bound, self.compute_lower_bound(head_set, all_set))
+
     def anonymize(self):
         raise NotImplementedError
 
     def generate_output(self):
         """
-        Map integers to value from original domain
+        Map integers to value from original domain. Each QI column becomes a Categorical of generalization labels
+        (categories sorted like strings), built from a lookup table of the intervals of the best anonymization.
         :return:
         """
-        anonymization = self.expand_head_set(self.best_head)
-        ds_ano_enum = self.generate_anonymized_dataset(anonymization)
-        df_ano = self.dataframe[self.quasi_identifiers].copy()
-        # Convert categorical columns to string
-        for column in df_ano.columns.values:
-            if df_ano[column].dtype.name == "category":
-                df_ano[column] = df_ano[column].astype(str)
-        # Replace enumerated values
-        for t_idx, t in enumerate(ds_ano_enum):
-            for v_idx, v in enumerate(t):
-                an_idx = anonymization.index(v)
-                end_value = anonymization[an_idx + 1] if an_idx < len(anonymization) - 1 else self.dom_values_enum[
-                                                                                                  -1] + 1
-                values = self.dom_values[v - 1:end_value - 1]
-                df_ano.iloc[t_idx, v_idx] = format_generalization(values)
-
-        missing_columns = set(self.original_column_order).difference(set(df_ano.columns))
-        df = pd.concat([df_ano, self.dataframe[missing_columns].copy()], axis=1)
-        df = df[self.original_column_order].sort_values(list(self.original_column_order), axis=0)
+        gen_idx, bounds = self._generalize(self.expand_head_set(self.best_head))
+        ends = np.append(bounds[1:], len(self.dom_values) + 1)
+        labels = np.array([format_generalization(self.dom_values[start - 1:end - 1])
+                           for start, end in zip(bounds, ends)], dtype=object)
+        # Intervals of column idx are bounds[column_bounds[idx]:column_bounds[idx + 1]]
+        column_bounds = np.searchsorted(bounds, self.most_general_anonymization + [len(self.dom_values) + 1])
+        df = self.dataframe[self.original_column_order].copy()
+        for idx, column in enumerate(self.quasi_identifiers):
+            first, last = column_bounds[idx], column_bounds[idx + 1]
+            categories = labels[first:last]
+            order = np.argsort(categories, kind="stable")
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            codes = rank[gen_idx[:, idx] - first]
+            df[column] = pd.Categorical.from_codes(codes, categories[order])
+        # Positions of the output rows (shared with generate_table)
+        rows = np.arange(len(df.index))
+        if self.sort_output:
+            rows = df.reset_index(drop=True).sort_values(list(self.original_column_order), axis=0).index.to_numpy()
         # Remove tuples
         if self.use_suppression:
-            df = suppress_only(df, self._k, self.quasi_identifiers)
+            sizes = group_sizes(df, self.quasi_identifiers, self.count_column)
+            rows = rows[sizes[rows] >= self._k]
+        self._output_rows = rows
 
-        return df
+        return df.iloc[rows]
+
+    def generate_table(self) -> GeneralizedTable:
+        """
+        Anonymized dataset (the rows of generate_output) as GeneralizedTable. The sets of each QI column are the
+        intervals of the best anonymization, no generalization strings are formatted.
+        """
+        gen_idx, bounds = self._generalize(self.expand_head_set(self.best_head))
+        ends = np.append(bounds[1:], len(self.dom_values) + 1)
+        column_bounds = np.searchsorted(bounds, self.most_general_anonymization + [len(self.dom_values) + 1])
+        rows = self._output_rows
+        columns = dict()
+        for column in self.original_column_order:
+            if column == self.count_column:
+                continue
+            if column not in self.quasi_identifiers:
+                columns[column] = GeneralizedColumn.from_series(self.dataframe[column].iloc[rows], generalized=False)
+                continue
+            idx = self.quasi_identifiers.index(column)
+            first, last = column_bounds[idx], column_bounds[idx + 1]
+            # Interval i covers the positions [starts[i], stops[i]) of the sorted domain
+            starts = bounds[first:last] - self.domain_offsets[idx] - 1
+            stops = ends[first:last] - self.domain_offsets[idx] - 1
+            positions = np.arange(len(self.domains[idx]))
+            sets = (starts[:, np.newaxis] <= positions) & (positions < stops[:, np.newaxis])
+            columns[column] = GeneralizedColumn(gen_idx[rows, idx] - first, sets, np.array(self.domains[idx]))
+        counts = None if self.weights is None else self.weights[rows]
+        return GeneralizedTable(columns, self.dataframe.index[rows], counts)
 
     def compute_cost(self, head_set):
         """
@@ -180,42 +597,74 @@ class BaseAnonymizer:
         - Tuple suppression costs infinity if disallowed
         - Each merge costs 1
 
-        :param head_set:
+        :param head_set: head set as bitmask
         :return:
         """
-        eq_classes = self.generate_eq_classes(head_set)
-        cost = len(self.sigma_all) - len(head_set)
-        for eqc, eqc_size in eq_classes:
-            if eqc_size >= self._k:
-                cost += eqc_size * eqc_size
-            else:
-                if self.use_suppression:
-                    cost += eqc_size * self.size
-                else:
-                    cost = float("inf")
-                    break
+        sizes = self.eq_class_sizes(head_set)
+        suppressed = sizes < self._k
+        if not self.use_suppression and suppressed.any():
+            return float("inf")
+        cost = len(self.sigma_all) - popcount(head_set)
+        cost += int(np.sum(sizes[~suppressed] ** 2)) + int(np.sum(sizes[suppressed])) * self.size
         return cost
 
     def compute_lower_bound(self, head_set, all_set) -> float:
-        eqc_head = self.generate_eq_classes(head_set)
-        if next((True for _, size in eqc_head if size < self._k), False):
+        if (self.eq_class_sizes(head_set) < self._k).any():
             return float("inf")
-        eqc_all = self.generate_eq_classes(all_set)
-        generalization_cost = len(self.sigma_all) - len(all_set)  # New, compared to Bayardo et al.
-        min_cost = sum(size * max(size, self._k) for _, size in eqc_all) + generalization_cost
+        sizes_all = self.eq_class_sizes(all_set)
+        generalization_cost = len(self.sigma_all) - popcount(all_set)  # New, compared to Bayardo et al.
+        min_cost = int(np.sum(sizes_all * np.maximum(sizes_all, self._k))) + generalization_cost
         return min_cost
 
 
-def suppress_only(df, k, QI):
-    s = list(set(df.columns.values).difference(set(QI)))[0]
-    group_obj = df[QI + [s]].groupby(QI)
-    group_counts = group_obj.count()
-    groups_to_delete = group_counts[group_counts[s] < k].index.values
+# Group size of tuples with missing QI values, they are not grouped and never suppressed
+UNGROUPED = np.iinfo(np.int64).max
+
+
+def group_sizes(df, QI, count_column=None) -> np.ndarray:
+    """
+    Size of the QI group of each tuple (UNGROUPED for tuples with missing QI values).
+
+    :param count_column: Column with the number of tuples per row (None if every row is one tuple)
+
+    :return: Array with one group size per row of df
+    """
+    # ngroup is NaN (float) for tuples with missing QI values
+    group_ids = df.groupby(QI, observed=True, sort=False).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    grouped = group_ids >= 0
+    if count_column is None:
+        sizes = np.bincount(group_ids[grouped])
+    else:
+        sizes = np.bincount(group_ids[grouped], weights=df[count_column].to_numpy()[grouped]).astype(np.int64)
+    return np.where(grouped, sizes[np.where(grouped, group_ids, 0)], UNGROUPED)
 
-    count = 0
-    df_new = df.copy()
-    for group in groups_to_delete:
-        df_new.drop(group_obj.groups[group], inplace=True)
-        count += len(group_obj.groups[group])
 
-    return df_new
+def suppress_only(df, k, QI, sizes=None, count_column=None):
+    """
+    Removes all tuples of QI groups smaller than k.
+
+    :param sizes: Group sizes of the tuples (see group_sizes), computed if None
+    :param count_column: Column with the number of tuples per row (None if every row is one tuple)
+    """
+    if sizes is None:
+        sizes = group_sizes(df, QI, count_column)
+    return df[sizes >= k]
+
+
+def suppress_sweep(df, QI, k_values=None, masks=False, sizes=None, count_column=None):
+    """
+    Suppression for several k with a single grouping of the dataset.
+
+    :param k_values: Values of k (default: 1 to the largest group size)
+    :param masks: Yield boolean row masks instead of datasets
+    :param sizes: Group sizes of the tuples (see group_sizes), computed if None
+    :param count_column: Column with the number of tuples per row (None if every row is one tuple)
+    :return: Generator of pairs of k and the dataset without suppressed tuples (or the mask of the kept tuples)
+    """
+    if sizes is None:
+        sizes = group_sizes(df, QI, count_column)
+    if k_values is None:
+        k_values = range(1, int(sizes[sizes < UNGROUPED].max(initial=0)) + 1)
+    for k in k_values:
+        mask = sizes >= k
+        yield k, mask if masks else df[mask]
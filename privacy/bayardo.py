@@ -1,72 +1,454 @@
-from typing import List
+import copy
+import hashlib
+import multiprocessing as mp
+import os
+import pickle
+import time
+from multiprocessing import shared_memory
 
-from privacy.base import BaseAnonymizer
+import numpy as np
+
+from privacy.base import BaseAnonymizer, BudgetExhausted, SharedBudget, split_budget, to_values
+
+# Read-only arrays which worker processes attach from shared memory
+SHARED_ARRAYS = ("dataset_enum", "_rows_by_value", "_value_ptr")
+
+
+class SearchFrame:
+    """
+    Node of the set-enumeration tree on the explicit search stack.
+    """
+    __slots__ = ("head", "tail", "cost", "order", "pos", "bit", "stage")
+
+    def __init__(self, head, tail, cost):
+        self.head = head
+        self.tail = tail
+        self.cost = cost
+        self.order = None
+        self.pos = 0
+        self.bit = 0
+        self.stage = 0
+
+
+class PruneFrame:
+    """
+    Call of prune(head, tail, best cost) on the explicit search stack.
+    """
+    __slots__ = ("head", "tail", "best_cost", "reduced", "pruned", "order", "pos", "bit", "stage")
+
+    def __init__(self, head, tail, best_cost):
+        self.head = head
+        self.tail = tail
+        self.best_cost = best_cost
+        self.reduced = None
+        self.pruned = None
+        self.order = None
+        self.pos = 0
+        self.bit = 0
+        self.stage = 0
 
 
 class BayardoAnonymizer(BaseAnonymizer):
-    CALL_CACHE = {}
+    """
+    The search (k_anonymize and prune of Bayardo et al.) runs on an explicit stack of frames instead of recursion. Each
+    step either finishes the top frame (its result is passed to the frame below) or pushes a child frame. The stack can
+    be saved to a checkpoint file (one per k), a later run with the same k resumes from it.
+
+    With several workers, the subtrees below the root are searched by a process pool. The workers share the best cost
+    for pruning, the enumerated dataset is shared read-only.
+    """
+    CALL_CACHE = None
+
+    def __init__(self, data_frame, quasi_identifiers, use_suppression=False, reorder_values=True,
+                 prune_useless=True, checkpoint_file=None, checkpoint_interval=60.0, checkpoint_caches=False,
+                 workers=1, **kwargs):
+        """
+
+        :param data_frame:
+        :param quasi_identifiers:
+        :param use_suppression:
+        :param reorder_values: Expand tail values in increasing order of the equivalence classes they induce
+        :param prune_useless: Remove tail values which make every descendant infeasible
+        :param checkpoint_file: Path of the checkpoints, the name of the file of each k gets the suffix -k<k> (None
+            disables checkpoints)
+        :param checkpoint_interval: Seconds between two checkpoints
+        :param checkpoint_caches: Also save the caches
+        :param workers: Number of processes for the search (None for one per CPU)
+        :param kwargs: See BaseAnonymizer
+        """
+        super(BayardoAnonymizer, self).__init__(data_frame, quasi_identifiers, use_suppression, **kwargs)
+        self.reorder_values = reorder_values
+        self.prune_useless = prune_useless
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_caches = checkpoint_caches
+        self.workers = workers or os.cpu_count()
+        self._stack = []
+        self._shared_best = None
+        if self.workers > 1 and checkpoint_file is not None:
+            raise ValueError("Checkpoints are not supported by the parallel search.")
+
+    @property
+    def cache_stats(self):
+        stats = super(BayardoAnonymizer, self).cache_stats
+        if self.CALL_CACHE is not None:
+            stats.update(calls=self.CALL_CACHE.stats)
+        return stats
 
     def _reset_state(self, k):
         super(BayardoAnonymizer, self)._reset_state(k)
-        self.CALL_CACHE = {}
+        # Memoized calls are not evicted, without them the search takes exponential time
+        self.CALL_CACHE = self.cache_type(None)
+        self._stack = []
 
     def anonymize(self):
-        self.k_anonymize([], self.sigma_all, self.best_cost)
-
-    def k_anonymize(self, head_set, tail_set, best_cost):
-        h = head_set
-        t = tail_set
-
-        t = self.prune_useless_values(h, t)
-        c = min(best_cost, self.compute_cost(h))
-        if c < self.best_cost:
-            self.best_head = h
-            self.best_cost = c
-
-        t = self.prune(h, t, c)
-        t = self.reorder_tail(h, t)
-        while t:
-            v = t[0]
-            h_new = h.copy()
-            h_new.append(v)
-            h_new.sort()
-            t.remove(v)
-            c = self.k_anonymize(h_new, t, c)
-            if c < self.best_cost:
-                self.best_head = h_new
-                self.best_cost = c
-            t = self.prune(h, t, c)
-        return c
+        if self.workers > 1:
+            self.search_parallel()
+            return
+        if not self.load_checkpoint():
+            self._stack = [SearchFrame(0, self.sigma_mask, self.best_cost)]
+        self.search()
+        if self.checkpoint_file is not None and os.path.exists(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
 
-    def prune_useless_values(self, head_set, tail_set):
-        return tail_set
+    def search(self):
+        """
+        Runs the search until the stack is empty. If the budget is exhausted, the open nodes bound the optimal cost and
+        the stack is saved (if checkpoints are enabled).
+
+        :return: Result of the bottom frame
+        """
+        last_checkpoint = time.monotonic()
+        result = None
+        try:
+            while self._stack:
+                frame = self._stack[-1]
+                if isinstance(frame, SearchFrame):
+                    child = self._step_search(frame, result)
+                else:
+                    child = self._step_prune(frame, result)
+                if child is None:
+                    self._stack.pop()
+                    result = frame.cost if isinstance(frame, SearchFrame) else frame.pruned
+                else:
+                    self._stack.append(child)
+                    result = None
+                    if self.checkpoint_file is not None and \
+                            time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                        self.save_checkpoint()
+                        last_checkpoint = time.monotonic()
+        except BudgetExhausted:
+            for frame in self._stack:
+                if isinstance(frame, SearchFrame):
+                    self._bound_open_nodes(frame.head, frame.head | frame.tail | frame.bit)
+            if self.checkpoint_file is not None:
+                self.save_checkpoint()
+            raise
+        return result
+
+    def _call(self, frame):
+        """
+        Runs a single frame to completion (on a new stack).
+        """
+        self._stack = [frame]
+        return self.search()
+
+    @property
+    def _pruning_cost(self):
+        """
+        Best cost known to this process, including solutions of other workers.
+        """
+        if self._shared_best is None:
+            return self.best_cost
+        return min(self.best_cost, self._shared_best.value)
+
+    def _update_incumbent(self, head_set, cost):
+        self.best_head = head_set
+        self.best_cost = cost
+        if self._shared_best is not None:
+            with self._shared_best.get_lock():
+                self._shared_best.value = min(self._shared_best.value, cost)
+
+    def _step_search(self, frame: SearchFrame, result):
+        """
+        k_anonymize(head, tail, best cost) of Bayardo et al.
 
-    def prune(self, head_set, tail_set, best_cost: float) -> List[int]:
-        call = (tuple(head_set), tuple(tail_set), best_cost)
-        if call not in self.CALL_CACHE:
-            self.CALL_CACHE[call] = self._prune(head_set, tail_set, best_cost)
-        return self.CALL_CACHE[call]
-
-    def _prune(self, head_set, tail_set, best_cost: float) -> List[int]:
-        all_set = sorted(head_set + tail_set)
-        lower_bound = self.compute_lower_bound(head_set, all_set)
-        if lower_bound >= best_cost:
-            return []
-
-        t_new = tail_set.copy()
-        for v in tail_set:
-            h_new = sorted(head_set + [v])
-            param_t_new = t_new.copy()
-            param_t_new.remove(v)
-            if self.prune(h_new, param_t_new, best_cost) == []:
+        :param frame: Top frame
+        :param result: Result of the last finished child frame
+        :return: Child frame or None if the frame is finished (its result is frame.cost)
+        """
+        h = frame.head
+        if frame.stage == 0:
+            t = self.prune_useless_values(h, frame.tail)
+            cost_h = self.compute_cost(h)
+            if cost_h < self._pruning_cost:
+                self._update_incumbent(h, cost_h)
+            c = min(frame.cost, cost_h, self._pruning_cost)
+            self._visit_node()
+            frame.tail = t
+            frame.cost = c
+            frame.stage = 1
+            return PruneFrame(h, t, c)
+        elif frame.stage == 1:
+            frame.tail = result
+            frame.order = self.reorder_tail(h, result)
+        elif frame.stage == 2:
+            frame.cost = min(result, self._pruning_cost)
+            frame.stage = 3
+            return PruneFrame(h, frame.tail, frame.cost)
+        else:
+            frame.tail = result
+
+        # Expand the next tail value
+        while frame.pos < len(frame.order):
+            bit = 1 << frame.order[frame.pos]
+            frame.pos += 1
+            if frame.tail & bit:
+                frame.tail ^= bit
+                frame.bit = bit
+                frame.stage = 2
+                return SearchFrame(h | bit, frame.tail, frame.cost)
+        return None
+
+    def _step_prune(self, frame: PruneFrame, result):
+        """
+        prune(head, tail, best cost) of Bayardo et al., results are cached.
+
+        :param frame: Top frame
+        :param result: Result of the last finished child frame
+        :return: Child frame or None if the frame is finished (its result is frame.pruned)
+        """
+        h = frame.head
+        best_cost = frame.best_cost
+        if frame.stage == 0:
+            pruned = self.CALL_CACHE.get((h, frame.tail, best_cost))
+            if pruned is not None:
+                frame.pruned = pruned
+                return None
+            self._visit_node()
+            t = self.prune_useless_values(h, frame.tail)
+            if self.compute_lower_bound(h, h | t) >= best_cost:
+                return self._finish_prune(frame, 0)
+            frame.reduced = t
+            frame.pruned = t
+            frame.order = self.reorder_tail(h, t)
+            frame.stage = 1
+        elif frame.stage == 1:
+            if result == 0:
+                h_new = h | frame.bit
                 cost_h_new = self.compute_cost(h_new)
+                self._offer_solution(h_new, cost_h_new)
                 if cost_h_new > best_cost:
-                    t_new.remove(v)
-        if t_new != tail_set:
-            # prune
-            return self.prune(head_set, t_new, best_cost)
+                    frame.pruned &= ~frame.bit
         else:
-            return t_new
+            return self._finish_prune(frame, result)
 
-    def reorder_tail(self, head_set, tail_set):
+        # Try to prune the next tail value
+        if frame.pos < len(frame.order):
+            frame.bit = 1 << frame.order[frame.pos]
+            frame.pos += 1
+            return PruneFrame(h | frame.bit, frame.pruned & ~frame.bit, best_cost)
+        if frame.pruned != frame.reduced:
+            # prune
+            frame.stage = 2
+            return PruneFrame(h, frame.pruned, best_cost)
+        return self._finish_prune(frame, frame.pruned)
+
+    def _finish_prune(self, frame: PruneFrame, pruned):
+        frame.pruned = pruned
+        self.CALL_CACHE.put((frame.head, frame.tail, frame.best_cost), pruned)
+        return None
+
+    def prune_useless_values(self, head_set, tail_set):
+        """
+        Removes tail values v for which head set + {v} induces an equivalence class smaller than k. Without suppression
+        every anonymization containing head set + {v} is then infeasible because classes only split further.
+        """
+        if not self.prune_useless or self.use_suppression:
+            return tail_set
+        for v in to_values(tail_set):
+            if (self.eq_class_sizes(head_set | 1 << v) < self._k).any():
+                tail_set ^= 1 << v
         return tail_set
+
+    def reorder_tail(self, head_set, tail_set):
+        """
+        Orders the tail values by the number of equivalence classes induced by head set + {v} (ascending, ties by
+        value).
+
+        :return: Tail values in the order in which they are expanded
+        """
+        values = to_values(tail_set)
+        if self.reorder_values:
+            values.sort(key=lambda v: len(self.eq_class_sizes(head_set | 1 << v)))
+        return values
+
+    def search_parallel(self):
+        """
+        Processes the root, then searches the subtrees of its tail values with a process pool. Subtrees get the tail
+        as it would be after expanding the preceding values, without the pruning done by those expansions.
+
+        The pool and the caches of its workers only live for one run. Unlike the caches of this process, they are not
+        kept for the next k, so in parallel mode only the incumbent of the previous run is warm.
+        """
+        try:
+            tail = self.prune_useless_values(0, self.sigma_mask)
+            cost = self.compute_cost(0)
+            if cost < self.best_cost:
+                self._update_incumbent(0, cost)
+            self._visit_node()
+            tail = self._call(PruneFrame(0, tail, self.best_cost))
+        except BudgetExhausted:
+            self._bound_open_nodes(0, self.sigma_mask)
+            raise
+        tasks = []
+        for v in self.reorder_tail(0, tail):
+            tail ^= 1 << v
+            tasks.append((1 << v, tail))
+        if not tasks:
+            return
+
+        ctx = mp.get_context()
+        best_cost = ctx.Value("d", self.best_cost)
+        nodes = ctx.Value("q", self._budget.nodes)
+        memory = []
+        try:
+            arrays = dict()
+            for name in SHARED_ARRAYS:
+                array = getattr(self, name)
+                shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                memory.append(shm)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+                arrays[name] = (shm.name, array.shape, array.dtype)
+            init_args = (self._worker_template(), arrays, best_cost, nodes, self._budget.deadline,
+                         self._budget.node_budget)
+            with ctx.Pool(min(self.workers, len(tasks)), _init_worker, init_args) as pool:
+                results = pool.map(_search_subtree, tasks, chunksize=1)
+        finally:
+            for shm in memory:
+                shm.close()
+                shm.unlink()
+
+        exhausted = False
+        for head, cost, fallback, node_count, lower_bound, stopped in results:
+            if cost < self.best_cost:
+                self.best_head, self.best_cost = head, cost
+            if fallback[1] < self._fallback[1]:
+                self._fallback = fallback
+            self.node_count += node_count
+            self.lower_bound = min(self.lower_bound, lower_bound)
+            exhausted |= stopped
+        self._budget.nodes = nodes.value
+        if exhausted:
+            raise BudgetExhausted()
+
+    def _worker_template(self):
+        """
+        Copy of the anonymizer for the worker processes without dataset, caches and search state. The workers start
+        with empty caches in every run (see search_parallel).
+        """
+        template = copy.copy(self)
+        template.dataframe = None
+        template._df_anonymized = None
+        for name in SHARED_ARRAYS:
+            setattr(template, name, None)
+        # The workers share the byte budget
+        template._eq_class_cache = self.cache_type(split_budget(self.cache_bytes, 2 * self.workers))
+        template._partition_cache = self.cache_type(split_budget(self.cache_bytes, 2 * self.workers))
+        template.CALL_CACHE = self.cache_type(None)
+        template._stack = []
+        template._budget = None
+        template.workers = 1
+        return template
+
+    def search_subtree(self, head_set, tail_set):
+        """
+        Searches one subtree in a worker process.
+
+        :return: Best head set and cost found in the subtree, fallback solution, number of visited nodes, lower bound
+        of the optimal cost and whether the budget was exhausted
+        """
+        self.best_head = None
+        self.best_cost = float("inf")
+        self.lower_bound = float("inf")
+        self.node_count = 0
+        self._fallback = (None, float("inf"))
+        stopped = False
+        try:
+            self._call(SearchFrame(head_set, tail_set, self._pruning_cost))
+        except BudgetExhausted:
+            stopped = True
+        return self.best_head, self.best_cost, self._fallback, self.node_count, self.lower_bound, stopped
+
+    @property
+    def _fingerprint(self):
+        """
+        Identifies dataset, search settings and k of a checkpoint.
+        """
+        digest = hashlib.sha1(self.dataset_enum.tobytes()).hexdigest()
+        return (digest, tuple(self.quasi_identifiers), self.use_suppression, self.reorder_values,
+                self.prune_useless, self._k)
+
+    @property
+    def _checkpoint_path(self):
+        """
+        Checkpoint file of the current k, checkpoints of other k are kept until their k is run again
+        """
+        root, ext = os.path.splitext(self.checkpoint_file)
+        return "{}-k{}{}".format(root, self._k, ext)
+
+    def save_checkpoint(self):
+        state = dict(
+            fingerprint=self._fingerprint,
+            stack=self._stack,
+            best_head=self.best_head,
+            best_cost=self.best_cost,
+            fallback=self._fallback,
+            node_count=self.node_count,
+            caches=(self.CALL_CACHE, self._eq_class_cache, self._partition_cache) if self.checkpoint_caches else None,
+        )
+        tmp_file = self._checkpoint_path + ".tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self._checkpoint_path)
+
+    def load_checkpoint(self) -> bool:
+        """
+        Restores the search from the checkpoint file if it belongs to this dataset, these settings and k.
+
+        :return: True if the search was restored
+        """
+        if self.checkpoint_file is None or not os.path.exists(self._checkpoint_path):
+            return False
+        with open(self._checkpoint_path, "rb") as f:
+            state = pickle.load(f)
+        if state["fingerprint"] != self._fingerprint:
+            print("WARNING: Ignoring checkpoint {} of another search".format(self._checkpoint_path))
+            return False
+        self._stack = state["stack"]
+        self.best_head = state["best_head"]
+        self.best_cost = state["best_cost"]
+        self._fallback = state["fallback"]
+        self.node_count = state["node_count"]
+        if state["caches"] is not None:
+            self.CALL_CACHE, self._eq_class_cache, self._partition_cache = state["caches"]
+        return True
+
+
+_worker = None
+_worker_memory = []
+
+
+def _init_worker(anonymizer, arrays, best_cost, nodes, deadline, node_budget):
+    global _worker
+    for name, (shm_name, shape, dtype) in arrays.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_memory.append(shm)
+        setattr(anonymizer, name, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    anonymizer._shared_best = best_cost
+    anonymizer._budget = SharedBudget(deadline, node_budget, nodes)
+    _worker = anonymizer
+
+
+def _search_subtree(task):
+    return _worker.search_subtree(*task)
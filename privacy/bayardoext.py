@@ -1,9 +1,20 @@
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
 import pandas as pd
+from pandas.api.types import is_categorical_dtype, union_categoricals
 
-from privacy.base import suppress_only
+from privacy.base import BaseAnonymizer, SearchBudget, SharedBudget, UNGROUPED, group_sizes, split_budget, \
+    suppress_only, suppress_sweep
 from privacy.bayardo import BayardoAnonymizer
+from privacy.table import GeneralizedTable
+
+# State of an anonymizer after a run which is sent back from the worker processes, including the caches which are kept
+# for the next k
+RESULT_ATTRIBUTES = ("best_head", "best_cost", "lower_bound", "optimal", "node_count", "reused", "stopped", "duration",
+                     "_k", "_df_anonymized", "_output_rows", "_eq_class_cache", "_partition_cache")
 
 
 class BayardoExtendedAnonymizer:
@@ -11,7 +22,8 @@ class BayardoExtendedAnonymizer:
     Optimal k-Anonymity [Bayardo et al.] to generate fairness
     """
 
-    def __init__(self, df, quasi_identifier, grouping_keys, use_suppression, use_generalization):
+    def __init__(self, df, quasi_identifier, grouping_keys, use_suppression, use_generalization, checkpoint_dir=None,
+                 group_workers=1, count_column=None, **kwargs):
         """
 
         :param df:
@@ -19,6 +31,11 @@ class BayardoExtendedAnonymizer:
         :param grouping_keys: Grouping for each anonymizer (can be empty)
         :param use_suppression:
         :param use_generalization:
+        :param checkpoint_dir: Directory for the checkpoints of the anonymizers (None disables checkpoints)
+        :param group_workers: Number of processes which run the anonymizers of the groups (None for one per CPU)
+        :param count_column: Column with the number of tuples each row stands for (None if every row is one tuple)
+        :param kwargs: Further arguments for each BayardoAnonymizer, cache_bytes is the budget of all anonymizers (split
+            by the number of tuples per group)
         """
         # Small integrity checks
         if set(quasi_identifier).intersection(grouping_keys):
@@ -30,18 +47,27 @@ class BayardoExtendedAnonymizer:
         self.use_suppression = use_suppression
         self.use_generalization = use_generalization
         self.suppression_qi = self.quasi_identifier + self.grouping_keys
+        self.count_column = count_column
         # Prepare
-        self.size = len(df.index)
+        self.size = len(df.index) if count_column is None else int(df[count_column].sum())
         self.duration = None
+        self._df_anonymized = None
+        self._group_sizes = None
+        self.group_workers = group_workers or os.cpu_count()
         if self.grouping_keys:
             groups = self.df.groupby(self.grouping_keys).groups
             self._df_groups = [self.df.iloc[g_idx] for _, g_idx in groups.items()]
         else:
             self._df_groups = [self.df]
         # State
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+        cache_bytes = kwargs.pop("cache_bytes", BaseAnonymizer.DEFAULT_CACHE_BYTES)
         self._anonymizers = [
-            BayardoAnonymizer(df_slice, self.quasi_identifier, use_suppression=use_suppression) for df_slice in
-            self._df_groups]
+            BayardoAnonymizer(df_slice, self.quasi_identifier, use_suppression=use_suppression,
+                              checkpoint_file=self._checkpoint_file(checkpoint_dir, idx), count_column=count_column,
+                              cache_bytes=split_budget(cache_bytes, 1, len(df_slice) / max(len(df), 1)), **kwargs)
+            for idx, df_slice in enumerate(self._df_groups)]
         # Print INFO
         print("INFO: Initialized {} groups".format(len(self._df_groups)))
         print("INFO: k_max = {}".format(self.k_max))
@@ -52,6 +78,12 @@ class BayardoExtendedAnonymizer:
         for idx, a in enumerate(self._anonymizers):
             print("DEBUG: Anonymizer {}: {} tuples, {} domain values".format(idx + 1, a.size, len(a.dom_values)))
 
+    @staticmethod
+    def _checkpoint_file(checkpoint_dir, idx):
+        if checkpoint_dir is None:
+            return None
+        return os.path.join(checkpoint_dir, "group{}.pkl".format(idx))
+
     @property
     def _suppression_only(self):
         return self.use_suppression and not self.use_generalization
@@ -59,12 +91,22 @@ class BayardoExtendedAnonymizer:
     @property
     def k_max(self):
         if self.grouping_keys and self.use_generalization:
-            return int(self.df.groupby(self.grouping_keys).count().min().min())
+            return int(group_sizes(self.df, self.grouping_keys, self.count_column).min())
         elif self._suppression_only:
-            return int(self.df.groupby(self.suppression_qi).count().max().min())
+            sizes = self.suppression_group_sizes
+            return int(sizes[sizes < UNGROUPED].max(initial=0))
         else:
             return int(self.size)
 
+    @property
+    def suppression_group_sizes(self):
+        """
+        Sizes of the groups (by QI and grouping keys) of all tuples, computed once for all k
+        """
+        if self._group_sizes is None:
+            self._group_sizes = group_sizes(self.df, self.suppression_qi, self.count_column)
+        return self._group_sizes
+
     @property
     def best_cost(self):
         if self._suppression_only:
@@ -72,11 +114,92 @@ class BayardoExtendedAnonymizer:
         else:
             return sum(a.best_cost for a in self._anonymizers)
 
+    @property
+    def lower_bound(self):
+        if self._suppression_only:
+            return -1
+        else:
+            return sum(a.lower_bound for a in self._anonymizers)
+
+    @property
+    def optimal(self):
+        return self._suppression_only or all(a.optimal for a in self._anonymizers)
+
+    @property
+    def stopped(self):
+        """
+        Whether the budget stopped the search of any group
+        """
+        return not self._suppression_only and any(a.stopped for a in self._anonymizers)
+
+    @property
+    def node_count(self):
+        if self._suppression_only:
+            return 0
+        else:
+            return sum(a.node_count for a in self._anonymizers)
+
+    def _print_progress(self, finished):
+        print("\rINFO: Anonymizing ... {:.2%}".format(finished / len(self._anonymizers)), end="", flush=True)
+
+    def _run_parallel(self, k, budget):
+        """
+        Runs the anonymizers of the groups with a process pool. The budget is shared by all workers, the results and
+        caches are copied back into the anonymizers of this process, so the workers of the next k start warm.
+        """
+        budget.start()
+        ctx = mp.get_context()
+        nodes = ctx.Value("q", budget.nodes)
+        init_args = (self._anonymizers, budget.deadline, budget.node_budget, nodes)
+        workers = min(self.group_workers, len(self._anonymizers))
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker, initargs=init_args) as executor:
+            futures = {executor.submit(_run_group, idx, k): idx for idx in range(len(self._anonymizers))}
+            for finished, future in enumerate(as_completed(futures), 1):
+                anonymizer = self._anonymizers[futures[future]]
+                for name, value in future.result().items():
+                    setattr(anonymizer, name, value)
+                self._print_progress(finished)
+        budget.nodes = nodes.value
+
     def generate_output(self):
         frames = [a.anonymized_df for a in self._anonymizers]
-        return pd.concat(frames)
+        df = pd.concat(frames)
+        # Concatenating Categoricals with different categories results in object columns
+        for column in self.quasi_identifier:
+            if all(is_categorical_dtype(f[column]) for f in frames):
+                df[column] = union_categoricals([f[column] for f in frames], sort_categories=True)
+        return df
+
+    @property
+    def anonymized_table(self):
+        """
+        Result of the last run as GeneralizedTable (see BaseAnonymizer.generate_table)
+        """
+        if self._df_anonymized is None:
+            return None
+        if self._suppression_only:
+            return GeneralizedTable.from_frame(self._df_anonymized, generalized=[], count_column=self.count_column)
+        return GeneralizedTable.concat([a.generate_table() for a in self._anonymizers])
+
+    def sweep(self, k_values=None, masks=False):
+        """
+        Suppression only: anonymizes for several k with a single grouping of the dataset (see suppress_sweep).
 
-    def run(self, k):
+        :param k_values: Values of k (default: 1 to k_max)
+        :param masks: Yield boolean row masks instead of datasets
+        :return: Generator of pairs of k and anonymized dataset (or mask)
+        """
+        if not self._suppression_only:
+            raise ValueError("Sweeps are only supported without generalization.")
+        return suppress_sweep(self.df, self.suppression_qi, k_values, masks, sizes=self.suppression_group_sizes)
+
+    def run(self, k, time_budget=None, node_budget=None):
+        """
+        :param k:
+        :param time_budget: Seconds (or timedelta) shared by all anonymizers
+        :param node_budget: Number of nodes shared by all anonymizers
+        :return: Anonymized dataset
+        """
         # Integrity checks
         if not 1 <= k <= self.k_max:
             raise ValueError("k must be from [1, {}]".format(self.k_max))
@@ -84,18 +207,44 @@ class BayardoExtendedAnonymizer:
         start = datetime.now()
         if self._suppression_only:
             print("INFO: Anonymizing ... ", end="", flush=True)
-            df = suppress_only(self.df, k, self.suppression_qi)
+            df = suppress_only(self.df, k, self.suppression_qi, sizes=self.suppression_group_sizes)
             print("done", flush=True)
             self.duration = datetime.now() - start
         else:
+            budget = SearchBudget(time_budget, node_budget)
             print("INFO: Anonymizing ... {:.2%}".format(0), end="", flush=True)
-            for idx, anonymizer in enumerate(self._anonymizers):
-                anonymizer.run(k)
-                print("\rINFO: Anonymizing ... {:.2%}".format((idx + 1.0) / len(self._anonymizers)), end="", flush=True)
+            if self.group_workers > 1 and len(self._anonymizers) > 1:
+                self._run_parallel(k, budget)
+            else:
+                for idx, anonymizer in enumerate(self._anonymizers):
+                    anonymizer.run(k, budget=budget)
+                    self._print_progress(idx + 1)
             print("")
             self.duration = datetime.now() - start
+            reused = sum(a.reused for a in self._anonymizers)
+            if reused:
+                print("INFO: Kept the solution of the previous k for {} groups".format(reused))
             df = self.generate_output()
+            if self.stopped:
+                print("INFO: Budget exhausted, cost {} (lower bound {})".format(self.best_cost, self.lower_bound))
 
         print("INFO: Finished in {}".format(self.duration))
 
+        self._df_anonymized = df
         return df
+
+
+_anonymizers = None
+_budget = None
+
+
+def _init_worker(anonymizers, deadline, node_budget, nodes):
+    global _anonymizers, _budget
+    _anonymizers = anonymizers
+    _budget = SharedBudget(deadline, node_budget, nodes)
+
+
+def _run_group(idx, k):
+    anonymizer = _anonymizers[idx]
+    anonymizer.run(k, budget=_budget)
+    return {name: getattr(anonymizer, name) for name in RESULT_ATTRIBUTES}
@@ -0,0 +1,143 @@
+import heapq
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+ARRAY_OVERHEAD = sys.getsizeof(np.empty(0))
+
+
+def estimate_size(obj) -> int:
+    """
+    Estimates the memory footprint of a cache key or value in bytes.
+
+    :param obj: NumPy array, (nested) tuple or list, or scalar
+    :return: Size in bytes
+    """
+    if isinstance(obj, np.ndarray):
+        return ARRAY_OVERHEAD + obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(estimate_size(x) for x in obj)
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """
+    Cache with a byte budget. Evicts the least recently used entries once the estimated size of all entries (keys and
+    values) exceeds the budget. A budget of None disables eviction.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def stats(self):
+        return dict(entries=len(self), bytes=self.nbytes, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value and counts a hit, or returns default and counts a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._touch(key, entry)
+        return entry[0]
+
+    def put(self, key, value, cost=1.0):
+        """
+        Stores a value. Values larger than the whole budget are not cached.
+
+        :param key: Hashable key
+        :param value: Value
+        :param cost: Estimated cost to recompute the value (ignored by LRU eviction)
+        """
+        size = estimate_size(key) + estimate_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._remove(key)
+        self._insert(key, (value, size, cost))
+        self.nbytes += size
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            self._remove(self._victim())
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def _touch(self, key, entry):
+        self._entries.move_to_end(key)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+
+    def _victim(self):
+        return next(iter(self._entries))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+
+class CostAwareCache(LRUCache):
+    """
+    Cache with a byte budget and GreedyDual-Size eviction: evicts the entry with the lowest recomputation cost per byte,
+    aged by an inflation value so that entries which are not accessed anymore eventually leave the cache.
+    """
+
+    def __init__(self, max_bytes=None):
+        super(CostAwareCache, self).__init__(max_bytes)
+        self._inflation = 0.0
+        self._priority = dict()
+        self._heap = []
+        self._counter = 0
+
+    def clear(self):
+        super(CostAwareCache, self).clear()
+        self._priority.clear()
+        self._heap = []
+
+    def _push(self, key, entry):
+        _, size, cost = entry
+        self._counter += 1
+        priority = (self._inflation + cost / size, self._counter)
+        self._priority[key] = priority
+        heapq.heappush(self._heap, (priority, key))
+        if len(self._heap) > 2 * len(self._priority) + 64:
+            # Drop outdated heap entries
+            self._heap = [(p, k) for k, p in self._priority.items()]
+            heapq.heapify(self._heap)
+
+    def _touch(self, key, entry):
+        self._push(key, entry)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self._push(key, entry)
+
+    def _victim(self):
+        while True:
+            priority, key = heapq.heappop(self._heap)
+            if self._priority.get(key) == priority:
+                self._inflation = priority[0]
+                return key
+
+    def _remove(self, key):
+        super(CostAwareCache, self)._remove(key)
+        self._priority.pop(key, None)
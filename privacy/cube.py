@@ -0,0 +1,65 @@
+import numpy as np
+
+from privacy.base import pack_keys
+
+
+class DataCube:
+    """
+    Histogram of the tuples over the finest-grained QI values (one axis per attribute). An anonymization merges
+    contiguous runs of values per attribute, so each equivalence class is a rectangular block of the histogram and the
+    class sizes are sums over blocks. They are computed from the histogram only, independent of the number of tuples.
+
+    Small domains use a dense array which is reduced with np.add.reduceat along each axis. Large domains use the
+    non-empty cells (COO format) whose coordinates are mapped to intervals and summed.
+    """
+    MAX_DENSE_CELLS = 2 ** 22
+
+    def __init__(self, codes, shape, dense=None, weights=None):
+        """
+
+        :param codes: Integer matrix with shape (rows, attributes), column j takes values from [0, shape[j])
+        :param shape: Domain size per attribute
+        :param dense: Use the dense histogram (default: if it has at most MAX_DENSE_CELLS cells)
+        :param weights: Number of tuples per row (default: 1)
+        """
+        self.shape = tuple(int(x) for x in shape)
+        n_cells = int(np.prod(self.shape, dtype=np.float64))
+        self.dense = n_cells <= self.MAX_DENSE_CELLS if dense is None else dense
+        keys = pack_keys(codes, self.shape)
+        if self.dense:
+            self.histogram = np.bincount(keys, weights=weights, minlength=n_cells).astype(np.int64).reshape(self.shape)
+        else:
+            _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            self.coords = codes[first].astype(np.int64)
+            self.counts = np.bincount(inverse, weights=weights).astype(np.int64)
+
+    @property
+    def cells(self):
+        """
+        Number of cells which are summed per anonymization
+        """
+        if self.dense:
+            return self.histogram.size
+        return len(self.counts)
+
+    def class_sizes(self, starts):
+        """
+        Sizes of the non-empty equivalence classes of an anonymization.
+
+        :param starts: Per attribute, sorted array of the first values of its intervals (always starting with 0)
+        :return: Array of class sizes
+        """
+        if self.dense:
+            block = self.histogram
+            for axis, axis_starts in enumerate(starts):
+                if len(axis_starts) < self.shape[axis]:
+                    block = np.add.reduceat(block, axis_starts, axis=axis)
+            sizes = block.ravel()
+        else:
+            intervals = np.column_stack([
+                np.searchsorted(axis_starts, self.coords[:, axis], side="right") - 1
+                for axis, axis_starts in enumerate(starts)])
+            keys = pack_keys(intervals, [len(axis_starts) for axis_starts in starts])
+            _, inverse = np.unique(keys, return_inverse=True)
+            sizes = np.bincount(inverse, weights=self.counts).astype(np.int64)
+        return sizes[sizes > 0]
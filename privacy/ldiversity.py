@@ -1,5 +1,11 @@
+import heapq
+from bisect import bisect_left, insort
+
+import numpy as np
 import pandas as pd
 
+from privacy.base import to_values
+from privacy.table import GeneralizedColumn, GeneralizedTable
 from utils import GEN_DELIMITER
 
 
@@ -28,75 +34,308 @@ def concat_label(l1: any, l2: any) -> tuple:
     return tuple(new)
 
 
-def cost_i(c1, c2):
+def cost_i(s1, s2):
     """
     Information loss of unifying clusters. Implements the discernibility metric.
-    :param c1:
-    :param c2:
+    :param s1: Size of the first cluster
+    :param s2: Size of the second cluster
     :return:
     """
-    return len(c1 + c2) ** 2 - len(c1) ** 2 - len(c2) ** 2
+    return (s1 + s2) ** 2 - s1 ** 2 - s2 ** 2
 
 
-def cost_d(l, c1, c2):
+def cost_d(l, h1, h2, union=False):
     """
-    Diversity cost
-    :param c1:
-    :param c2:
+    Diversity cost. Without union, it is l for every merge: the original implementation added the sensitive values of
+    the clusters aligned by row label, which left no values to count.
+    :param h1: Sensitive value counts of the first cluster
+    :param h2: Sensitive value counts of the second cluster
+    :param union: Count the distinct sensitive values of the unified cluster
     :return:
     """
-    return max(0, l - div(c1 + c2))
+    if not union:
+        return l
+    return max(0, l - np.count_nonzero(h1 + h2))
+
+
+def cost(l, c1, c2, w=0.5, union=False):
+    """
+    :param c1: Pair of size and sensitive value counts of the first cluster
+    :param c2: Pair of size and sensitive value counts of the second cluster
+    :param union: Diversity cost of the unified cluster (see cost_d)
+    """
+    return w * cost_i(c1[0], c2[0]) + (1 - w) * cost_d(l, c1[1], c2[1], union)
+
+
+class _Clusters:
+    """
+    Groups during the merging. Ids increase with the insertion order, so ties are broken towards older groups. Groups
+    are indexed by diversity (heap) and by size and set of sensitive values (buckets in insertion order). Merge costs
+    only depend on these, so the first group of each bucket is the only candidate of its bucket.
+
+    Merged groups point to their successor (parent), labels are tuples of bitmasks (one per QI) over the generalized
+    values (see _LabelIndex).
+    """
+
+    def __init__(self, sizes, histograms, labels, union_diversity=False):
+        self.clusters = dict()
+        self.union_diversity = union_diversity
+        self.labels = []
+        self.parent = []
+        self.n_groups = len(labels)
+        self._by_div = []
+        self._by_size = dict()
+        self._sizes = []
+        for size, histogram, label in zip(sizes, histograms, labels):
+            self.add((int(size), histogram), label)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    @staticmethod
+    def _values(histogram) -> int:
+        return sum(1 << int(v) for v in np.flatnonzero(histogram))
+
+    def add(self, cluster, label):
+        cid = len(self.parent)
+        size, histogram = cluster
+        self.clusters[cid] = cluster
+        self.labels.append(label)
+        self.parent.append(cid)
+        heapq.heappush(self._by_div, (np.count_nonzero(histogram), cid))
+        if size not in self._by_size:
+            self._by_size[size] = dict()
+            insort(self._sizes, size)
+        self._by_size[size].setdefault(self._values(histogram), dict())[cid] = cluster
+        return cid
+
+    def remove(self, cid):
+        size, histogram = self.clusters.pop(cid)
+        values = self._values(histogram)
+        buckets = self._by_size[size]
+        del buckets[values][cid]
+        if not buckets[values]:
+            del buckets[values]
+        if not buckets:
+            del self._by_size[size]
+            del self._sizes[bisect_left(self._sizes, size)]
+
+    def merge(self, cid1, cid2):
+        (s1, h1), (s2, h2) = self.clusters[cid1], self.clusters[cid2]
+        label = tuple(m1 | m2 for m1, m2 in zip(self.labels[cid1], self.labels[cid2]))
+        self.remove(cid1)
+        self.remove(cid2)
+        cid = self.add((s1 + s2, h1 + h2), label)
+        self.parent[cid1] = self.parent[cid2] = cid
+
+    def min_div(self):
+        """
+        :return: Pair of diversity and id of the first group with minimal diversity
+        """
+        while self._by_div[0][1] not in self.clusters:
+            heapq.heappop(self._by_div)
+        return self._by_div[0]
+
+    def best_partner(self, l, cid, w=0.5):
+        """
+        First group with minimal merge cost. Groups are visited by increasing size, larger groups are skipped once the
+        information loss alone exceeds the best cost (the diversity cost is at most l).
+        """
+        cluster = self.clusters[cid]
+        best_cost, best_cid = float("inf"), None
+        for size in self._sizes:
+            if w * cost_i(cluster[0], size) > best_cost:
+                break
+            for bucket in self._by_size[size].values():
+                other_cid = next((c for c in bucket if c != cid), None)
+                if other_cid is None:
+                    continue
+                c = cost(l, cluster, bucket[other_cid], w, self.union_diversity)
+                if c < best_cost or (c == best_cost and other_cid < best_cid):
+                    best_cost, best_cid = c, other_cid
+        return best_cid
+
+    def merge_until(self, l):
+        """
+        Merges groups until each group has l distinct sensitive values (or only one group is left).
+        """
+        min_div, min_cid = self.min_div()
+        while min_div < l and len(self) > 1:
+            self.merge(min_cid, self.best_partner(l, min_cid))
+            min_div, min_cid = self.min_div()
+
+    def assignment(self):
+        """
+        :return: Id of the current group of each initial group
+        """
+        parent = np.asarray(self.parent)
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                return parent[:self.n_groups]
+            parent = grand_parent
+
+
+class _LabelIndex:
+    """
+    Generalized values of the QIs as bitmasks: bit i of column j stands for the i-th value (generalizations are split
+    into their values, like concat_label does).
+    """
+
+    def __init__(self, labels, width):
+        """
+
+        :param labels: Labels of the initial groups (tuples of width generalized values)
+        """
+        self._index = [dict() for _ in range(width)]
+        self.masks = [[self.mask(idx, label) for label in column_labels]
+                      for idx, column_labels in enumerate(zip(*labels))]
+
+    @property
+    def values(self):
+        return [list(index) for index in self._index]
+
+    def mask(self, idx, label) -> int:
+        """
+        Bitmask of the values of a label of column idx (new values get the next bits)
+        """
+        mask = 0
+        for value in self._split(label):
+            mask |= 1 << self._index[idx].setdefault(value, len(self._index[idx]))
+        return mask
+
+    @staticmethod
+    def _split(label):
+        label = str(label)
+        if label.startswith("{"):
+            return label[1:-1].split(GEN_DELIMITER)
+        return [label]
+
+    @property
+    def labels(self):
+        """
+        :return: Label of each initial group as tuple of bitmasks
+        """
+        return list(zip(*self.masks))
 
+    def format(self, idx, mask):
+        values = self.values[idx]
+        return "{{{}}}".format(GEN_DELIMITER.join(sorted(values[v] for v in to_values(mask))))
 
-def cost(l, c1, c2, w=0.5):
-    return w * cost_i(c1, c2) + (1 - w) * cost_d(l, c1, c2)
+    def column(self, idx, codes, masks) -> GeneralizedColumn:
+        """
+        Column of sets given as bitmasks of column idx
 
+        :param codes: Set per row (-1 if missing)
+        :param masks: Bitmask per set
+        """
+        values = self.values[idx]
+        domain = np.array(sorted(values))
+        positions = np.searchsorted(domain, values)
+        sets = np.zeros((len(masks), len(domain)), dtype=bool)
+        for set_idx, mask in enumerate(masks):
+            sets[set_idx, positions[to_values(mask)]] = True
+        return GeneralizedColumn(codes, sets, domain).deduplicated()
 
-def get_min_div_group(groups):
-    min_div = float("inf")
-    min_label = None
-    for label, group in groups.items():
-        c_div = div(group)
-        if c_div < min_div:
-            min_div = c_div
-            min_label = label
-    return min_label, min_div
 
+def _merged_table(df, quasi_identifiers, row_groups, clusters, label_index, count_column):
+    """
+    Post-processed dataset as GeneralizedTable: rows of a group get the label bitmasks of their group, rows with missing
+    QI values keep their values.
+    """
+    grouped = row_groups >= 0
+    groups, group_codes = np.unique(row_groups[grouped], return_inverse=True)
+    columns = dict()
+    for column in df.columns:
+        if column == count_column:
+            continue
+        if column not in quasi_identifiers:
+            columns[column] = GeneralizedColumn.from_series(df[column], generalized=False)
+            continue
+        idx = quasi_identifiers.index(column)
+        value_codes, values = pd.factorize(df[column].to_numpy()[~grouped])
+        masks = [clusters.labels[cid][idx] for cid in groups] + [label_index.mask(idx, value) for value in values]
+        codes = np.full(len(df.index), -1, dtype=np.int64)
+        codes[grouped] = group_codes
+        codes[~grouped] = np.where(value_codes >= 0, value_codes + len(groups), -1)
+        columns[column] = label_index.column(idx, codes, masks)
+    counts = None if count_column is None else df[count_column].to_numpy()
+    return GeneralizedTable(columns, df.index.to_numpy(), counts)
 
-def post_process_k_anonymity(df, l, sensitive, quasi_identifiers):
-    df = df.copy()
 
-    if div(df[sensitive]) < l:
-        raise ValueError("Maximal diversity is {}, but l = {}".format(div(df[sensitive]), l))
+def post_process_l_sweep(df, l_values, sensitive, quasi_identifiers, as_groups=False, union_diversity=False,
+                         count_column=None, as_table=False):
+    """
+    Post-processes a k-anonymous dataset for increasing l in one merge run: the groups for l are merged further for the
+    next l. The first l gives the same result as post_process_k_anonymity, later ones may differ from a separate run
+    (which can choose other merges for smaller diversities).
+
+    :param l_values: Values of l (processed in increasing order)
+    :param as_groups: Yield the group id of each row (-1 for rows with missing QI values) instead of the dataset
+    :param union_diversity: Merge costs count the distinct sensitive values of the unified group (see cost_d)
+    :param count_column: Column with the number of tuples per row (None if every row is one tuple)
+    :param as_table: Yield the dataset as GeneralizedTable, built from the label bitmasks of the groups
+    :return: Generator of pairs of l and the l-diverse dataset (or group ids)
+    """
+    l_values = sorted(l_values)
+    if l_values and div(df[sensitive]) < l_values[-1]:
+        raise ValueError("Maximal diversity is {}, but l = {}".format(div(df[sensitive]), l_values[-1]))
 
     quasi_identifiers = sorted(quasi_identifiers)
-    groups = {k: v for k, v in df.groupby(quasi_identifiers)[sensitive]}
-
-    # Merge groups
-    min_label, min_div = get_min_div_group(groups)
-    while min_div < l and len(groups) > 1:
-        min_cost = float("inf")
-        partner_label = None
-        for label, group in groups.items():
-            if label != min_label:
-                cur_cost = cost(l, groups[min_label], group)
-                if cur_cost < min_cost:
-                    partner_label = label
-                    min_cost = cur_cost
-
-        new_label = concat_label(min_label, partner_label)
-        new_group = pd.concat((groups[min_label], groups[partner_label]))
-        del groups[min_label]
-        del groups[partner_label]
-        groups[new_label] = new_group
-
-        min_label, min_div = get_min_div_group(groups)
-
-    # Refactor dataframe
+    # Categorical QIs are grouped as strings: groupby(observed=True) orders their groups by first appearance, but the
+    # group order breaks ties between merges
+    df_base = df.copy()
     for column in quasi_identifiers:
-        if df[column].dtype.name == "category":
-            df[column] = df[column].astype(str)
-    for label, rows in groups.items():
-        df.loc[rows.index, quasi_identifiers] = label
+        if df_base[column].dtype.name == "category":
+            df_base[column] = df_base[column].astype(str).mask(df_base[column].isna())
+    grouped = df_base.groupby(quasi_identifiers)
+    # ngroup is NaN (float) for rows with missing QI values
+    group_ids = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    group_sizes = grouped.size() if count_column is None else grouped[count_column].sum()
+    labels = [label if isinstance(label, tuple) else (label,) for label in group_sizes.index]
+    label_index = _LabelIndex(labels, len(quasi_identifiers))
+    # Sensitive value counts per group
+    codes, uniques = pd.factorize(df[sensitive])
+    valid = (group_ids >= 0) & (codes >= 0)
+    histograms = np.zeros((len(labels), len(uniques)), dtype=np.int64)
+    weights = np.ones(len(df), dtype=np.int64) if count_column is None else df[count_column].to_numpy()
+    np.add.at(histograms, (group_ids[valid], codes[valid]), weights[valid])
+    clusters = _Clusters(group_sizes.to_numpy(), histograms, label_index.labels, union_diversity)
 
-    return df
+    for l in l_values:
+        clusters.merge_until(l)
+        assignment = clusters.assignment()
+        row_groups = np.where(group_ids >= 0, assignment[np.maximum(group_ids, 0)], -1)
+        if as_groups:
+            yield l, row_groups
+            continue
+        if as_table:
+            yield l, _merged_table(df_base, quasi_identifiers, row_groups, clusters, label_index, count_column)
+            continue
+        # Refactor dataframe (only rows of merged groups)
+        df_l = df_base.copy()
+        rows = np.flatnonzero(row_groups >= clusters.n_groups)
+        if len(rows):
+            merged, inverse = np.unique(row_groups[rows], return_inverse=True)
+            for idx, column in enumerate(quasi_identifiers):
+                merged_labels = np.array([label_index.format(idx, clusters.labels[cid][idx]) for cid in merged],
+                                         dtype=object)
+                values = df_l[column].to_numpy(dtype=object, copy=True)
+                values[rows] = merged_labels[inverse]
+                df_l[column] = values
+        yield l, df_l
+
+
+def post_process_k_anonymity(df, l, sensitive, quasi_identifiers, union_diversity=False, count_column=None,
+                             as_table=False):
+    """
+    Merges groups until each group has l distinct sensitive values: the first group with minimal diversity is merged
+    with the group of minimal merge cost (see cost).
+
+    :param union_diversity: Merge costs count the distinct sensitive values of the unified group (see cost_d)
+    :param count_column: Column with the number of tuples per row (None if every row is one tuple)
+    :param as_table: Return the dataset as GeneralizedTable (see post_process_l_sweep)
+    """
+    _, df_l = next(post_process_l_sweep(df, [l], sensitive, quasi_identifiers, union_diversity=union_diversity,
+                                        count_column=count_column, as_table=as_table))
+    return df_l
@@ -1,15 +1,83 @@
 import numpy as np
+import pandas as pd
 from pandas import DataFrame
 
+from privacy.base import pack_keys
 
-def get_k(df: DataFrame, quasi_identifiers: list):
-    rows = df[quasi_identifiers].values
-    hashes = np.array([hash(tuple(x)) for x in rows])
-    _, counts = np.unique(hashes, return_counts=True)
-    return int(counts.min()), len(counts)
 
+def factorize_groups(df: DataFrame, quasi_identifiers: list):
+    """
+    Enumerates the distinct QI tuples (a missing value is a value of its own).
 
-def get_l_distinct(df: DataFrame, sensitive, quasi_identifiers: list):
-    df_grouped = df.groupby(quasi_identifiers).nunique()
-    min_l = int(df_grouped[sensitive].min())
-    return min_l if min_l > 0 else 1
+    :return: Pair of group code per row and number of groups
+    """
+    columns = []
+    radices = []
+    for column in quasi_identifiers:
+        codes, uniques = pd.factorize(df[column])
+        columns.append(codes + 1)
+        radices.append(len(uniques) + 1)
+    keys = pack_keys(np.column_stack(columns), radices)
+    _, group_codes = np.unique(keys, return_inverse=True)
+    return group_codes, int(group_codes.max(initial=-1)) + 1
+
+
+def _weights(df: DataFrame, count_column):
+    return None if count_column is None else df[count_column].to_numpy()
+
+
+def get_k(df: DataFrame, quasi_identifiers: list, count_column=None):
+    group_codes, n_groups = factorize_groups(df, quasi_identifiers)
+    counts = np.bincount(group_codes, weights=_weights(df, count_column))
+    return int(counts.min()), n_groups
+
+
+def get_l_distinct(df: DataFrame, sensitive, quasi_identifiers: list, count_column=None):
+    return get_metrics(df, sensitive, quasi_identifiers, count_column)["l_distinct"]
+
+
+def get_metrics(df: DataFrame, sensitive, quasi_identifiers: list, count_column=None) -> dict:
+    """
+    Privacy metrics of a dataset from a single grouping by the QIs:
+    - k: size of the smallest group
+    - n_groups: number of groups
+    - l_distinct: smallest number of distinct sensitive values in a group (at least 1)
+    - l_entropy: exp of the smallest entropy of the sensitive values in a group
+    - t_closeness: largest distance between the distribution of sensitive values in a group and in the dataset (equal
+      ground distance, i.e. total variation distance)
+
+    :param count_column: Column with the number of tuples per row (None if every row is one tuple)
+    :return: Dictionary of metrics
+    """
+    weights = _weights(df, count_column)
+    group_codes, n_groups = factorize_groups(df, quasi_identifiers)
+    sizes = np.bincount(group_codes, weights=weights, minlength=n_groups)
+
+    # Counts of sensitive values per group as (group, value) pairs, missing sensitive values are ignored
+    s_codes, s_uniques = pd.factorize(df[sensitive])
+    n_values = max(len(s_uniques), 1)
+    valid = s_codes >= 0
+    pairs, pair_idx = np.unique(group_codes[valid] * n_values + s_codes[valid], return_inverse=True)
+    pair_counts = np.bincount(pair_idx, weights=None if weights is None else weights[valid])
+    pair_groups, pair_values = np.divmod(pairs[pair_counts > 0], n_values)
+    pair_counts = pair_counts[pair_counts > 0]
+
+    # Distributions of the sensitive values per group (p) and in the dataset (q)
+    group_totals = np.bincount(pair_groups, weights=pair_counts, minlength=n_groups)
+    p = pair_counts / group_totals[pair_groups]
+    q = np.bincount(pair_values, weights=pair_counts, minlength=n_values)
+    q = q / max(q.sum(), 1)
+    entropy = -np.bincount(pair_groups, weights=p * np.log(p), minlength=n_groups)
+    # Values missing in a group contribute q, hence 0.5 * (sum of |p - q| - q over present values + 1)
+    distance = 0.5 * (np.bincount(pair_groups, weights=np.abs(p - q[pair_values]) - q[pair_values],
+                                  minlength=n_groups) + 1)
+    has_values = group_totals > 0
+
+    l_distinct = int(np.bincount(pair_groups, minlength=n_groups).min()) if n_groups else 0
+    return dict(
+        k=int(sizes.min()) if n_groups else 0,
+        n_groups=n_groups,
+        l_distinct=l_distinct if l_distinct > 0 else 1,
+        l_entropy=float(np.exp(entropy[has_values].min())) if has_values.any() else 1.0,
+        t_closeness=float(distance[has_values].max(initial=0.0)),
+    )
@@ -1,8 +1,9 @@
-import random
-
+import numpy as np
 import pandas as pd
 
-from utils import gen2set, is_gen
+from privacy.base import pack_keys
+from privacy.table import GeneralizedTable
+from utils import COUNT_COLUMN, REPLICATE_COLUMN, gen2set, is_gen
 
 
 def resample_cartesian(df: pd.DataFrame, qi):
@@ -19,12 +20,116 @@ def resample_cartesian(df: pd.DataFrame, qi):
     return df_new
 
 
-def resample_uniform(df: pd.DataFrame, qi):
+def _as_table(df, qi, count_column=COUNT_COLUMN) -> GeneralizedTable:
+    if isinstance(df, GeneralizedTable):
+        return df
+    return GeneralizedTable.from_frame(df, qi, count_column)
+
+
+def _merge(codes, radices, weights):
     """
-    :param df:
-    :return:
+    Merges equal rows of a code matrix and sums their weights.
     """
-    df_new = df.applymap(lambda x: random.choice(list(gen2set(x))) if is_gen(x) else x)
-    df_new.reset_index(inplace=True)
+    _, first, inverse = np.unique(pack_keys(codes + 1, [radix + 1 for radix in radices]),
+                                  return_index=True, return_inverse=True)
+    return codes[first], np.bincount(inverse, weights=weights).astype(np.int64)
+
+
+def _decode(codes, domain):
+    values = np.full(codes.shape, np.nan, dtype=object)
+    values[codes >= 0] = domain[codes[codes >= 0]]
+    return values
+
+
+def resample_cartesian_counts(df, qi, count_column=COUNT_COLUMN, seed=None):
+    """
+    Weighted resample_cartesian (as utils.compress of its result, without the index column): every row adds its count
+    to the cartesian product of the value sets of its generalized cells. The product is expanded one column at a time
+    on integer codes and equal rows are merged after every column, so the size is bounded by the number of distinct
+    rows of the result instead of the number of its rows.
+
+    :param df: Generalized dataset (weighted if it has count_column) or GeneralizedTable
+    :param qi: Quasi-identifiers which were generalized
+    :param count_column: Name of the count column
+    :param seed: Unused, the result is deterministic (same signature as resample_uniform)
+    :return: Dataset of distinct rows with count_column
+    """
+    table = _as_table(df, qi, count_column)
+    columns = list(table.columns)
+    weights = table.counts if table.counts is not None else np.ones(len(table), dtype=np.int64)
+
+    members = [table[column].members() for column in columns]
+    domains = [table[column].domain for column in columns]
+    radices = [len(cell_values) for cell_values in members]
+    codes, weights = _merge(np.column_stack([table[column].codes for column in columns]) if columns
+                            else np.zeros((len(table), 0), dtype=np.int64), radices, weights)
+
+    # Replace the cell codes by value codes, one column at a time
+    for idx, values in enumerate(members):
+        radices[idx] = len(domains[idx])
+        if not values:
+            continue
+        sizes = np.array([len(cell_values) for cell_values in values], dtype=np.int64)
+        offsets = np.cumsum(sizes) - sizes
+        cells = codes[:, idx]
+        present = cells >= 0
+        row_sizes = np.where(present, sizes[cells], 1)
+        rows = np.repeat(np.arange(len(codes)), row_sizes)
+        within = np.arange(len(rows)) - np.repeat(np.cumsum(row_sizes) - row_sizes, row_sizes)
+        positions = np.where(present, offsets[cells], 0)[rows] + within
+        codes = codes[rows]
+        codes[:, idx] = np.where(present[rows], np.concatenate(values)[positions], -1)
+        weights = weights[rows]
+        if sizes.max() > 1:
+            codes, weights = _merge(codes, radices, weights)
+
+    df_new = pd.DataFrame({column: _decode(codes[:, idx], domains[idx]) for idx, column in enumerate(columns)})
+    df_new[count_column] = weights
+    return df_new
+
+
+def resample_uniform(df, qi, seed=None, replicates=None):
+    """
+    Replaces every generalized cell by one of its values, drawn uniformly at random. The value sets are computed once
+    per distinct cell and all draws of a column are done in one call.
+
+    :param df: Generalized dataset (its index becomes a column) or GeneralizedTable (its index is kept). Weighted rows
+        (with COUNT_COLUMN) are expanded into one row per tuple, each tuple draws its own values.
+    :param qi: Quasi-identifiers which were generalized
+    :param seed: Seed or np.random.Generator
+    :param replicates: Number of resampled datasets, stacked with their number in REPLICATE_COLUMN (default: a single
+        dataset without REPLICATE_COLUMN)
+    :return: Resampled dataset
+    """
+    rng = np.random.default_rng(seed)
+    n_replicates = 1 if replicates is None else replicates
+    if isinstance(df, GeneralizedTable):
+        table = df
+        df_new = table.to_frame()
+        counts = table.counts
+    else:
+        table = GeneralizedTable.from_frame(df[qi], qi)
+        df_new = df.reset_index()
+        counts = df[COUNT_COLUMN].to_numpy() if COUNT_COLUMN in df.columns else None
+    rows = np.arange(len(table))
+    if counts is not None:
+        rows = np.repeat(rows, counts)
+        df_new = df_new.iloc[rows].drop(columns=COUNT_COLUMN)
+    if replicates is not None:
+        df_new = df_new.iloc[np.tile(np.arange(len(rows)), n_replicates)].reset_index(drop=True)
+        df_new.insert(0, REPLICATE_COLUMN, np.repeat(np.arange(n_replicates), len(rows)))
+
+    for column in qi:
+        values = table[column]
+        if not len(values.sets):
+            continue
+        sizes = values.sets.sum(axis=1)
+        offsets = np.cumsum(sizes) - sizes
+        codes = values.codes[rows]
+        present = codes >= 0
+        draws = rng.integers(0, np.where(present, sizes[codes], 1), size=(n_replicates, len(rows)))
+        positions = np.where(present, offsets[codes], 0) + draws
+        df_new[column] = _decode(np.where(present, np.concatenate(values.members())[positions], -1),
+                                 values.domain).ravel()
 
     return df_new
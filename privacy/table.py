@@ -0,0 +1,268 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import COUNT_COLUMN, format_generalization, gen2set, is_gen
+
+
+TABLE_FORMATS = ("npz", "parquet", "feather", "csv")
+
+INDEX_COLUMN = "__index__"
+
+
+def _table_format(file):
+    table_format = os.path.splitext(str(file))[1][1:]
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format of {file}, expected one of {TABLE_FORMATS}")
+    return table_format
+
+
+def _stored_columns(file, table_format):
+    """
+    Column names of a Parquet or Feather file, read from its schema
+    """
+    if table_format == "parquet":
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(file).names
+    import pyarrow
+    return pyarrow.ipc.open_file(pyarrow.memory_map(str(file))).schema.names
+
+
+def _code_type(n_codes):
+    """
+    Smallest signed integer type for the codes -1, ..., n_codes - 1
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_codes <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+class GeneralizedColumn:
+    """
+    Column of a generalized table: every row refers to a set of values of the attribute domain. The distinct sets are
+    stored once as bitmasks over the domain (one row of a boolean matrix per set).
+    """
+    __slots__ = ("codes", "sets", "domain")
+
+    def __init__(self, codes, sets, domain):
+        """
+
+        :param codes: Set per row (-1 if missing)
+        :param sets: Boolean matrix with shape (sets, values), row s is the bitmask of set s
+        :param domain: Sorted values of the attribute
+        """
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.sets = np.asarray(sets, dtype=bool)
+        self.domain = np.asarray(domain)
+
+    @classmethod
+    def from_series(cls, column: pd.Series, generalized=True):
+        """
+        Parses a column of generalization strings ("{a; b}"), each distinct string is parsed once.
+
+        :param generalized: Parse generalization strings, otherwise every cell is a value
+        """
+        codes, cells = pd.factorize(column)
+        cell_values = [gen2set(cell) if generalized and isinstance(cell, str) and is_gen(cell) else [cell]
+                       for cell in cells]
+        domain = np.array(sorted(set(value for values in cell_values for value in values)))
+        sets = np.zeros((len(cell_values), len(domain)), dtype=bool)
+        for idx, values in enumerate(cell_values):
+            sets[idx, np.searchsorted(domain, list(values))] = True
+        # Different strings may stand for the same set (e.g. "{a}" and "a")
+        return cls(codes, sets, domain).deduplicated()
+
+    def deduplicated(self):
+        """
+        Column in which equal sets are stored once
+        """
+        if not len(self.sets):
+            return self
+        sets, inverse = np.unique(self.sets, axis=0, return_inverse=True)
+        codes = np.where(self.codes >= 0, inverse.ravel()[np.maximum(self.codes, 0)], -1)
+        return GeneralizedColumn(codes, sets, self.domain)
+
+    @classmethod
+    def concat(cls, columns):
+        """
+        Stacks the rows of several columns, their sets are mapped to the union of the domains.
+        """
+        domain = np.unique(np.concatenate([column.domain for column in columns]))
+        codes, sets, n_sets = [], [], 0
+        for column in columns:
+            column_sets = np.zeros((len(column.sets), len(domain)), dtype=bool)
+            column_sets[:, np.searchsorted(domain, column.domain)] = column.sets
+            sets.append(column_sets)
+            codes.append(np.where(column.codes >= 0, column.codes + n_sets, -1))
+            n_sets += len(column.sets)
+        return cls(np.concatenate(codes), np.concatenate(sets), domain).deduplicated()
+
+    @property
+    def generalized(self):
+        return bool((self.sets.sum(axis=1) > 1).any())
+
+    def members(self):
+        """
+        Enumerated values per set
+
+        :return: List of arrays of indexes into the domain
+        """
+        return [np.flatnonzero(mask) for mask in self.sets]
+
+    def to_series(self, strings=True):
+        """
+        Values as Categorical (categories sorted). Sets of generalized columns become generalization strings ("{a; b}")
+        if strings, otherwise the column must not be generalized.
+        """
+        if strings and self.generalized:
+            labels = np.array([format_generalization(self.domain[values]) for values in self.members()], dtype=object)
+        elif self.generalized:
+            raise ValueError("Column contains generalized values")
+        else:
+            labels = self.domain[self.sets.argmax(axis=1)] if len(self.sets) else self.domain[:0]
+        order = np.argsort(labels, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        codes = np.where(self.codes >= 0, rank[np.maximum(self.codes, 0)] if len(rank) else -1, -1)
+        return pd.Categorical.from_codes(codes, labels[order])
+
+
+class GeneralizedTable:
+    """
+    Typed representation of a generalized dataset: per column the set code of every row and a side table of the sets
+    as bitmasks over the attribute domain (see GeneralizedColumn). Optionally with a count per row.
+
+    Stored as .npz with the arrays of column j under "j/codes", "j/sets" (bits packed per set) and "j/domain". Parquet,
+    Feather and CSV files hold the Categorical columns of to_frame (with generalization strings) instead, their
+    categories are parsed once when loading.
+    """
+
+    def __init__(self, columns: dict, index=None, counts=None):
+        """
+
+        :param columns: GeneralizedColumn per column name (in column order)
+        :param index: Row labels (default: 0, ..., n - 1)
+        :param counts: Number of tuples per row (None if every row is one tuple)
+        """
+        self.columns = dict(columns)
+        size = len(next(iter(self.columns.values())).codes) if self.columns else 0
+        self.index = np.arange(size) if index is None else np.asarray(index)
+        self.counts = None if counts is None else np.asarray(counts, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, column) -> GeneralizedColumn:
+        return self.columns[column]
+
+    def take(self, rows):
+        """
+        Table of the given row positions
+        """
+        columns = {name: GeneralizedColumn(values.codes[rows], values.sets, values.domain)
+                   for name, values in self.columns.items()}
+        return GeneralizedTable(columns, self.index[rows], None if self.counts is None else self.counts[rows])
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Stacks the rows of tables with the same columns
+        """
+        columns = {name: GeneralizedColumn.concat([table[name] for table in tables]) for name in tables[0].columns}
+        counts = None if tables[0].counts is None else np.concatenate([table.counts for table in tables])
+        return cls(columns, np.concatenate([table.index for table in tables]), counts)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, generalized=None, count_column=COUNT_COLUMN):
+        """
+        Converts a dataset with generalization strings
+
+        :param generalized: Columns which may contain generalization strings (default: all)
+        :param count_column: Name of the count column (used if it exists)
+        """
+        columns = {column: GeneralizedColumn.from_series(df[column], generalized is None or column in generalized)
+                   for column in df.columns if column != count_column}
+        counts = df[count_column].to_numpy() if count_column in df.columns else None
+        return cls(columns, index=df.index.to_numpy(), counts=counts)
+
+    def to_frame(self, strings=True, count_column=COUNT_COLUMN):
+        """
+        Dataset of Categorical columns
+
+        :param strings: Export generalized columns as generalization strings ("{a; b}"), otherwise the table must not
+            contain generalizations
+        :param count_column: Name of the count column (if the table has counts)
+        """
+        generalized = [column for column, values in self.columns.items() if values.generalized]
+        if generalized and not strings:
+            raise ValueError(f"Columns {generalized} contain generalized values")
+        df = pd.DataFrame({column: values.to_series(strings) for column, values in self.columns.items()},
+                          index=self.index)
+        if self.counts is not None:
+            df[count_column] = self.counts
+        return df
+
+    def save(self, file, table_format=None):
+        """
+
+        :param file: Path
+        :param table_format: One of TABLE_FORMATS (default: extension of file)
+        """
+        table_format = table_format or _table_format(file)
+        if table_format != "npz":
+            df = self.to_frame()
+            if table_format == "csv":
+                df.to_csv(file)
+            elif table_format == "parquet":
+                df.to_parquet(file)
+            else:
+                # Feather stores no index
+                df.rename_axis(INDEX_COLUMN).reset_index().to_feather(file)
+            return
+
+        arrays = dict(columns=np.array(list(self.columns), dtype=str), index=self.index)
+        if self.counts is not None:
+            arrays["counts"] = self.counts
+        for idx, values in enumerate(self.columns.values()):
+            arrays[f"{idx}/codes"] = values.codes.astype(_code_type(len(values.sets)))
+            arrays[f"{idx}/sets"] = np.packbits(values.sets, axis=1)
+            arrays[f"{idx}/domain"] = values.domain.astype(str) if values.domain.dtype == object else values.domain
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file, columns=None, table_format=None):
+        """
+
+        :param file: Path
+        :param columns: Columns to read (default: all), the counts are always read
+        :param table_format: One of TABLE_FORMATS (default: extension of file)
+        """
+        table_format = table_format or _table_format(file)
+        if table_format == "csv":
+            df = pd.read_csv(file, header=0, index_col=0)
+            if columns is not None:
+                df = df[[column for column in df.columns if column in columns or column == COUNT_COLUMN]]
+            return cls.from_frame(df)
+        if table_format in ("parquet", "feather"):
+            if columns is not None:
+                columns = [column for column in _stored_columns(file, table_format)
+                           if column in columns or column == COUNT_COLUMN]
+            if table_format == "parquet":
+                df = pd.read_parquet(file, columns=columns)
+            else:
+                df = pd.read_feather(file, columns=None if columns is None else [INDEX_COLUMN] + columns)
+                df = df.set_index(INDEX_COLUMN).rename_axis(None)
+            return cls.from_frame(df)
+
+        # Arrays of an npz file are read on access only
+        with np.load(file) as arrays:
+            loaded = {}
+            for idx, column in enumerate(arrays["columns"]):
+                if columns is not None and column not in columns:
+                    continue
+                domain = arrays[f"{idx}/domain"]
+                sets = np.unpackbits(arrays[f"{idx}/sets"], axis=1, count=len(domain)).astype(bool)
+                loaded[str(column)] = GeneralizedColumn(arrays[f"{idx}/codes"], sets, domain)
+            return cls(loaded, index=arrays["index"], counts=arrays["counts"] if "counts" in arrays else None)
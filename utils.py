@@ -1,10 +1,17 @@
 import re
 from typing import List
 
+import numpy as np
+import pandas as pd
+
 INTERVAL_PATTERN = re.compile(r"[\[(][\d.]+, [\d.]+[)\]]")
 
 GEN_DELIMITER = "; "
 
+COUNT_COLUMN = "count"
+
+REPLICATE_COLUMN = "replicate"
+
 
 def format_generalization(values):
     return "{{{}}}".format(GEN_DELIMITER.join(str(x) for x in values))
@@ -30,6 +37,41 @@ def clean_adult(in_file, out_file):
     print("Removed {} lines".format(counter))
 
 
+def _factorize_with_na(column):
+    """
+    Integer codes of a column, missing values get a code of their own
+    """
+    codes, uniques = pd.factorize(column)
+    return np.where(codes < 0, len(uniques), codes)
+
+
+def compress(df, count_column=COUNT_COLUMN):
+    """
+    Weighted representation of a dataset: distinct rows and the number of their occurrences.
+
+    :param df: Dataset (already weighted if it has count_column)
+    :param count_column: Name of the count column
+    :return: Dataset of distinct rows with count_column
+    """
+    columns = [c for c in df.columns if c != count_column]
+    # Grouped by codes, groupby would drop missing values
+    codes = [_factorize_with_na(df[c]) for c in columns]
+    group_ids = df.groupby(codes, sort=False).ngroup().to_numpy()
+    _, first = np.unique(group_ids, return_index=True)
+    weights = df[count_column].to_numpy() if count_column in df.columns else None
+    df_counts = df[columns].iloc[first].reset_index(drop=True)
+    df_counts[count_column] = np.bincount(group_ids, weights=weights).astype(np.int64)
+    return df_counts
+
+
+def expand(df, count_column=COUNT_COLUMN):
+    """
+    Row representation of a weighted dataset (see compress).
+    """
+    df = df.loc[df.index.repeat(df[count_column])]
+    return df.drop(columns=count_column).reset_index(drop=True)
+
+
 def get_domain(df, attrs: List):
     if len(attrs) > 1:
         return set(map(tuple, df[attrs].to_numpy()))